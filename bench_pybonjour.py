@@ -0,0 +1,241 @@
+################################################################################
+#
+# Copyright (c) 2007-2008 Christopher J. Stawarz
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT.  IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+################################################################################
+
+
+"""
+
+Benchmarks for the parts of pybonjour that run in the application's
+process.  None of them require the DNS-SD library or daemon.  Run
+
+  python bench_pybonjour.py [name ...]
+
+to run the named benchmarks (by default, all of them).
+
+"""
+
+import gc
+import sys
+import time
+
+from pybonjour import *
+
+
+def _best_time(func, number, repeat=3):
+    # Returns the best time, in seconds, per call of func
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        for j in range(number):
+            func()
+        elapsed = (time.time() - start) / number
+        if (best is None) or (elapsed < best):
+            best = elapsed
+    return best
+
+
+def _report(fmt, *args):
+    sys.stdout.write((fmt % args) + '\n')
+
+
+def _make_txt_data(size):
+    # Returns the wire form of a TXT record of about size bytes,
+    # made up of items like those of real services
+    txt = TXTRecord(strict=False)
+    i = 0
+    while len(str(txt)) < size:
+        txt['key%d' % i] = 'value-%d-%s' % (i, 'x' * (i % 16))
+        i += 1
+    return str(txt), len(txt)
+
+
+def _parse_by_slicing(data):
+    # TXTRecord.parse() as it was before version 1.2.0, for comparison
+    txt = TXTRecord(strict=False)
+    while data:
+        length = ord(data[0])
+        item = data[1:length+1].split('=', 1)
+        if item[0] and (item[0] not in txt):
+            if len(item) == 1:
+                txt[item[0]] = None
+            else:
+                txt[item[0]] = item[1]
+        data = data[length+1:]
+    return txt
+
+
+def _bytes_per_object(objects):
+    # Returns the memory, in bytes, taken by objects and everything
+    # they refer to (other than types), divided by their number.
+    # Objects shared between them, such as interned strings, are
+    # counted once.
+    seen = set()
+    total = 0
+    pending = list(objects)
+    while pending:
+        obj = pending.pop()
+        if (id(obj) in seen) or isinstance(obj, type):
+            continue
+        seen.add(id(obj))
+        total += sys.getsizeof(obj)
+        pending.extend(gc.get_referents(obj))
+    return total // len(objects)
+
+
+def bench_txt_parse():
+    'TXTRecord.parse() on records of increasing size'
+    _report('%8s %6s %14s %14s %10s', 'bytes', 'keys', 'parse (us)',
+            'slicing (us)', 'ns/byte')
+    for size in (1024, 8192, 32768, 65000):
+        data, keys = _make_txt_data(size)
+        number = max(1, 200000 // len(data))
+        parse = _best_time(lambda: TXTRecord.parse(data), number)
+        slicing = _best_time(lambda: _parse_by_slicing(data), number)
+        _report('%8d %6d %14.1f %14.1f %10.1f', len(data), keys, parse * 1e6,
+                slicing * 1e6, parse * 1e9 / len(data))
+
+
+def bench_txt_lookup():
+    'Looking up one key with TXTRecord.parse() and LazyTXTRecord'
+    _report('%8s %6s %14s %14s %14s', 'bytes', 'keys', 'parse (us)',
+            'lazy (us)', 'lazy last (us)')
+    for size in (128, 1024, 8192):
+        data, keys = _make_txt_data(size)
+        last = 'key%d' % (keys - 1)
+        number = max(1, 200000 // len(data))
+        parse = _best_time(lambda: TXTRecord.parse(data)['key1'], number)
+        lazy = _best_time(lambda: LazyTXTRecord(data)['key1'], number)
+        lazy_last = _best_time(lambda: LazyTXTRecord(data)[last], number)
+        _report('%8d %6d %14.1f %14.1f %14.1f', len(data), keys, parse * 1e6,
+                lazy * 1e6, lazy_last * 1e6)
+
+
+def bench_txt_str():
+    'str() of an unchanged TXTRecord, and of one modified before each call'
+    _report('%8s %6s %14s %14s', 'bytes', 'keys', 'cached (us)',
+            'modified (us)')
+    for size in (128, 1024, 8192):
+        data, keys = _make_txt_data(size)
+        txt = TXTRecord.parse(data)
+        number = max(1, 200000 // len(data))
+        cached = _best_time(lambda: str(txt), number * 100)
+        def modify_and_str():
+            txt['key0'] = 'value-0-'
+            str(txt)
+        modified = _best_time(modify_and_str, number)
+        _report('%8d %6d %14.2f %14.2f', len(data), keys, cached * 1e6,
+                modified * 1e6)
+
+
+def bench_txt_edit():
+    'Setting, getting and deleting TXTRecord keys, per key'
+    _report('%8s %14s %14s %14s', 'keys', 'set (us)', 'get (us)',
+            'delete (us)')
+    for size in (1, 10, 100, 1000):
+        names = ['key%d' % i for i in range(size)]
+        number = max(1, 10000 // size)
+
+        def set_all():
+            txt = TXTRecord()
+            for name in names:
+                txt[name] = 'value'
+            return txt
+
+        txt = set_all()
+        def get_all():
+            for name in names:
+                txt[name]
+
+        # Only the deletions are timed, so the records are built
+        # beforehand.  Keys are deleted newest first, the worst order
+        # for a list.
+        reversed_names = names[::-1]
+        delete_time = None
+        for i in range(3):
+            records = [set_all() for j in range(number)]
+            start = time.time()
+            for record in records:
+                for name in reversed_names:
+                    del record[name]
+            elapsed = (time.time() - start) / number
+            if (delete_time is None) or (elapsed < delete_time):
+                delete_time = elapsed
+
+        set_time = _best_time(set_all, number)
+        get_time = _best_time(get_all, number)
+        _report('%8d %14.3f %14.3f %14.3f', size, set_time * 1e6 / size,
+                get_time * 1e6 / size, delete_time * 1e6 / size)
+
+
+def bench_memory():
+    'Bytes per object for TXT records and service instances'
+    number = 10000
+    wire = []
+    for i in range(number):
+        txt = TXTRecord()
+        for name, value in (('txtvers', '1'), ('version', '2.1'),
+                            ('weight', str(i % 10)), ('path', '/'),
+                            ('id', str(i))):
+            txt[name] = value
+        wire.append(str(txt))
+
+    # Each record is parsed from, and each instance decoded from,
+    # separate reply data, as happens when they are discovered
+    _report('%-24s %10s', 'TXT record', 'bytes')
+    for cls in (TXTRecord, LazyTXTRecord, CompactTXTRecord):
+        records = [cls.parse(data) for data in wire]
+        _report('%-24s %10d', cls.__name__, _bytes_per_object(records))
+
+    names = [('Service %d' % i, '_http._tcp.', 'local.')
+             for i in range(number)]
+    _report('%-24s %10s', 'service instance', 'bytes')
+    for name, factory in (('tuple', lambda *args: args),
+                          ('ServiceInstance', ServiceInstance)):
+        instances = [factory(*[part.decode('utf-8') for part in parts])
+                     for parts in names]
+        _report('%-24s %10d', name, _bytes_per_object(instances))
+
+
+benchmarks = [
+    ('txt_parse', bench_txt_parse),
+    ('txt_lookup', bench_txt_lookup),
+    ('txt_str', bench_txt_str),
+    ('txt_edit', bench_txt_edit),
+    ('memory', bench_memory),
+    ]
+
+
+def main(argv):
+    names = argv[1:]
+    for name, func in benchmarks:
+        if names and (name not in names):
+            continue
+        _report('%s: %s', name, func.__doc__)
+        func()
+        _report('')
+
+
+if __name__ == '__main__':
+    main(sys.argv)
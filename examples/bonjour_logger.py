@@ -1,4 +1,3 @@
-import select
 import sys
 import logging
 from contextlib import contextmanager
@@ -12,8 +11,6 @@ logger.setLevel(logging.INFO)
 
 BROWSER = pybonjour.DNSServiceBrowse
 RESOLVER = pybonjour.DNSServiceResolve
-LISTENER = pybonjour.DNSServiceProcessResult
-REFERENCE = pybonjour.DNSServiceRef
 
 def get_service(bjoursrv):
    name, proto = bjoursrv.replace("_", "")[:-1].split(".")
@@ -27,11 +24,13 @@ def get_service(bjoursrv):
 class Dispatcher:
 
    def __init__(self, srvtypes):
-      mkref = lambda srvtype: pybonjour.DNSServiceBrowse(regtype=srvtype, callBack=self._handle_event)
-      self._registrations = [mkref(srvtype) for srvtype in srvtypes]
+      self._loop = pybonjour.ServiceLoop()
+      for srvtype in srvtypes:
+         self._loop.add(BROWSER(regtype=srvtype, callBack=self._handle_event))
 
    def __iadd__(self, sdref):
-      self._registrations.update([sdref])
+      self._loop.add(sdref)
+      return self
 
    def _handle_event(self, sdRef, flags, ifaceidx, error, srvname, regtype, replyfrm):
       "upon a browser event receipt"
@@ -43,21 +42,19 @@ class Dispatcher:
          return
       logger.info("SERVICE: '%s' (%s) at %s" % (srvname, get_service(regtype), replyfrm))
 
-      new_ref = pybonjour.DNSServiceResolve(0, ifaceidx, srvname, regtype, replyfrm, callBack=self._handle_resolved)
-      self._registrations.append(new_ref)
+      self._loop.add(RESOLVER(0, ifaceidx, srvname, regtype, replyfrm, callBack=self._handle_resolved))
 
    def _handle_resolved(self, sdref, flags, ifaceidx, err, srvname, replyfrm, port, txt):
       "upon resolve reply receipt"
       logger.info("resolved: %s at %s" % (srvname, replyfrm))
-      self._registrations.remove(sdref)
+      self._loop.remove(sdref, close=True)
 
    def __call__(self):
       logger.info("---- starting browser ----")
-      while True:
-         for results in select.select(self._registrations, [], []):
-            for sdref in self._registrations:
-               if sdref in results:
-                  pybonjour.DNSServiceProcessResult(sdref)
+      try:
+         self._loop.run()
+      finally:
+         self._loop.close()
 
 if __name__=="__main__":
 
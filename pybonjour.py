@@ -46,6 +46,11 @@ non-convertible str will result in an exception.)  Strings returned
 from pybonjour (either directly from API functions or passed to
 application callbacks) are always unicode instances.
 
+Note on library loading: The DNS-SD library is loaded the first time
+it's needed, rather than when pybonjour is imported.  To use a
+library other than the platform's standard one, pass its path to
+load() before calling any DNS-SD functions.
+
 """
 
 
@@ -53,11 +58,20 @@ __author__   = 'Christopher Stawarz <cstawarz@gmail.com>'
 __version__  = '1.1.1'
 
 
+import collections
 import ctypes
+import errno
+import heapq
+import itertools
+import operator
 import os
 import re
+import select
 import socket
+import struct
 import sys
+import threading
+import time
 
 
 
@@ -79,34 +93,103 @@ class _DummyLock(object):
     def release():
         pass
 
-_global_lock = _DummyLock()
+
+class _LoaderLock(object):
+
+    # Stands in for the global lock until the DNS-SD library has been
+    # loaded, since only then do we know what kind of lock we need.
+    # Every call into the library is made with the global lock held,
+    # so acquiring it is what triggers the load.
+
+    @staticmethod
+    def acquire():
+        load()
+        _global_lock.acquire()
+
+    @staticmethod
+    def release():
+        _global_lock.release()
+
+_global_lock = _LoaderLock()
 
 
 if sys.platform == 'win32':
     # Need to use the stdcall variants
-    _libdnssd = ctypes.windll.dnssd
     _CFunc = ctypes.WINFUNCTYPE
 else:
-    if sys.platform == 'darwin':
-        _libdnssd = 'libSystem.B.dylib'
-    else:
-        _libdnssd = 'libdns_sd.so.1'
+    _CFunc = ctypes.CFUNCTYPE
 
-        # If libdns_sd is actually Avahi's Bonjour compatibility
-        # layer, silence its annoying warning messages, and use a real
-        # RLock as the global lock, since the compatibility layer
-        # isn't thread safe.
-        try:
-            ctypes.cdll.LoadLibrary('libavahi-client.so.3')
-        except OSError:
-            pass
+
+_libdnssd = None
+_libdnssd_path = None
+_load_lock = threading.Lock()
+
+
+def load(path=None):
+
+    """
+
+    Load the DNS-SD library.  This happens automatically the first
+    time a DNS-SD function is called, so applications need to call
+    load() only if they want to choose which library is used, by
+    passing its path, or to find out at a convenient time whether one
+    is available.  If path is None, the platform's standard library
+    is used.  Raises OSError if the library can't be loaded.
+
+    Once a library has been loaded, calling load() again has no
+    effect, unless path names a different library, in which case
+    ValueError is raised.
+
+    """
+
+    global _libdnssd, _libdnssd_path, _global_lock
+
+    if (_libdnssd is not None) and (path is None):
+        return
+
+    _load_lock.acquire()
+    try:
+        if _libdnssd is not None:
+            if (path is not None) and (path != _libdnssd_path):
+                raise ValueError('DNS-SD library already loaded from %r' %
+                                 _libdnssd_path)
+            return
+
+        lock = _DummyLock()
+
+        if sys.platform == 'win32':
+            if path is None:
+                path = 'dnssd'
+            lib = ctypes.windll.LoadLibrary(path)
         else:
-            os.environ['AVAHI_COMPAT_NOWARN'] = '1'
-            import threading
-            _global_lock = threading.RLock()
+            if path is None:
+                if sys.platform == 'darwin':
+                    path = 'libSystem.B.dylib'
+                else:
+                    path = 'libdns_sd.so.1'
+
+            if sys.platform != 'darwin':
+                # If libdns_sd is actually Avahi's Bonjour
+                # compatibility layer, silence its annoying warning
+                # messages, and use a real RLock as the global lock,
+                # since the compatibility layer isn't thread safe.
+                try:
+                    ctypes.cdll.LoadLibrary('libavahi-client.so.3')
+                except OSError:
+                    pass
+                else:
+                    os.environ['AVAHI_COMPAT_NOWARN'] = '1'
+                    lock = threading.RLock()
 
-    _libdnssd = ctypes.cdll.LoadLibrary(_libdnssd)
-    _CFunc = ctypes.CFUNCTYPE
+            lib = ctypes.cdll.LoadLibrary(path)
+
+        # Threads that find the library loaded must also find the
+        # right lock, so set the lock first
+        _global_lock = lock
+        _libdnssd_path = path
+        _libdnssd = lib
+    finally:
+        _load_lock.release()
 
 
 
@@ -134,6 +217,7 @@ kDNSServiceFlagsLongLivedQuery      = 0x100
 kDNSServiceFlagsAllowRemoteQuery    = 0x200
 kDNSServiceFlagsForceMulticast      = 0x400
 kDNSServiceFlagsReturnCNAME         = 0x800
+kDNSServiceFlagsShareConnection     = 0x4000
 
 
 #
@@ -224,6 +308,7 @@ kDNSServiceErr_NoSuchKey            = -65556
 kDNSServiceErr_NATTraversal         = -65557
 kDNSServiceErr_DoubleNAT            = -65558
 kDNSServiceErr_BadTime              = -65559
+kDNSServiceErr_Timeout              = -65568
 
 
 #
@@ -277,6 +362,7 @@ class BonjourError(Exception):
         kDNSServiceErr_NATTraversal:		'NAT traversal',
         kDNSServiceErr_DoubleNAT:		'double NAT',
         kDNSServiceErr_BadTime:			'bad time',
+        kDNSServiceErr_Timeout:			'timeout',
         }
 
     @classmethod
@@ -291,6 +377,16 @@ class BonjourError(Exception):
                            (errorCode, self._errmsg.get(errorCode, 'unknown')))
 
 
+class CancelledError(Exception):
+
+    """
+
+    Exception raised when retrieving the result of a Future that was
+    cancelled.
+
+    """
+
+
 
 ################################################################################
 #
@@ -422,19 +518,32 @@ class DNSServiceRef(DNSRecordRef):
     def __init__(self, *args, **kwargs):
         DNSRecordRef.__init__(self, *args, **kwargs)
 
-        # Since callback functions are called asynchronously, we need
-        # to hold onto references to them for as long as they're in
-        # use.  Otherwise, Python could deallocate them before we call
-        # DNSServiceProcessResult(), meaning the Bonjour library would
-        # dereference freed memory when it tried to invoke the
-        # callback.
+        # Callback functions are called asynchronously, via the static
+        # trampolines, which find them in _callback_table using the
+        # context value passed to the DNS-SD library, along with the
+        # instance to pass to them as sdRef.  We keep track of our
+        # keys so that the table entries can be removed when we're
+        # closed.
         self._callbacks = []
 
         # A DNSRecordRef is invalidated if DNSServiceRefDeallocate()
         # is called on the corresponding DNSServiceRef, so we need to
         # keep track of all our record refs and invalidate them when
-        # we're closed.
-        self._record_refs = []
+        # we're closed.  Record refs are keyed by their pointer value
+        # and stored with the key of their callback (if any), so that
+        # both can be released as soon as the record is removed;
+        # otherwise, a long-lived connection that registers and
+        # removes records would accumulate them indefinitely.
+        self._record_refs = {}
+
+        # Likewise, deallocating a DNSServiceRef created by
+        # DNSServiceCreateConnection() also deallocates the
+        # DNSServiceRefs sharing its connection.  _primary is the
+        # connection a shared DNSServiceRef belongs to, and
+        # _subordinates maps the id() of each DNSServiceRef sharing
+        # our connection to the instance itself.
+        self._primary = None
+        self._subordinates = {}
 
     def __enter__(self):
         return self
@@ -442,33 +551,80 @@ class DNSServiceRef(DNSRecordRef):
     def __exit__(self, type, value, traceback):
         self.close()
 
-    def _add_callback(self, cb):
-        self._callbacks.append(cb)
+    def _add_callback(self, key, cb):
+        # Callbacks are added before making the DNS-SD call that's
+        # passed their key, since on a shared connection another
+        # thread may process the first reply before the call returns
+        _callback_table[key] = (self, cb)
+        self._callbacks.append(key)
+
+    def _remove_callback(self, key):
+        _callback_table.pop(key, None)
+        self._callbacks.remove(key)
+
+    def _add_record_ref(self, ref, key=None):
+        self._record_refs[ref.value] = (ref, key)
+
+    def _remove_record_ref(self, ref):
+        entry = self._record_refs.pop(ref.value, None)
+        if entry is not None:
+            entry[0]._invalidate()
+            if entry[1] is not None:
+                _callback_table.pop(entry[1], None)
+        ref._invalidate()
+
+    def _add_subordinate(self, sdRef):
+        sdRef._primary = self
+        self._subordinates[id(sdRef)] = sdRef
+
+    def _connection(self):
+        # Returns the DNSServiceRef that owns our connection
+        if self._primary is not None:
+            return self._primary
+        return self
+
+    def _release(self):
+        # Forget our resources once they've been deallocated
+        for ref, key in self._record_refs.values():
+            ref._invalidate()
+            if key is not None:
+                _callback_table.pop(key, None)
+        del self._record_refs
+
+        self._invalidate()
 
-    def _add_record_ref(self, ref):
-        self._record_refs.append(ref)
+        for key in self._callbacks:
+            _callback_table.pop(key, None)
+        del self._callbacks
 
     def close(self):
         """
 
         Close the connection to the mDNS daemon and terminate any
-        associated browse, resolve, etc. operations.
+        associated browse, resolve, etc. operations.  Closing a
+        DNSServiceRef created by DNSServiceCreateConnection() also
+        terminates the operations sharing its connection (and closes
+        their DNSServiceRefs), whereas closing a DNSServiceRef that
+        shares a connection terminates only its own operation.
 
         """
 
         if self._valid():
-            for ref in self._record_refs:
-                ref._invalidate()
-            del self._record_refs
-
             _global_lock.acquire()
             try:
                 _DNSServiceRefDeallocate(self)
             finally:
                 _global_lock.release()
 
-            self._invalidate()
-            del self._callbacks
+            for sdRef in self._subordinates.values():
+                sdRef._release()
+            self._subordinates.clear()
+
+            if self._primary is not None:
+                self._primary._subordinates.pop(id(self), None)
+                self._primary = None
+
+            self._release()
 
     def fileno(self):
         """
@@ -477,12 +633,14 @@ class DNSServiceRef(DNSRecordRef):
         This descriptor should never be read from or written to
         directly.  It should only be passed to select() or poll() to
         determine when a response from the mDNS daemon is available.
+        A DNSServiceRef that shares a connection returns the
+        connection's descriptor.
 
         """
 
         _global_lock.acquire()
         try:
-            fd = _DNSServiceRefSockFD(self)
+            fd = _DNSServiceRefSockFD(self._connection())
         finally:
             _global_lock.release()
 
@@ -566,6 +724,37 @@ _DNSServiceQueryRecordReply = _CFunc(
     )
 
 
+# Creating a ctypes callback object is expensive, so rather than
+# creating one per operation, each reply type has a single static
+# trampoline.  Every operation is assigned an integer key, which is
+# passed to the DNS-SD library as the context argument, and the
+# trampoline uses it to look up the operation's callback function in
+# _callback_table.  The table also holds the DNSServiceRef that owns
+# the operation, which is passed to the callback in place of the new
+# instance ctypes creates for each call, so that a callback that
+# closes its sdRef (or removes it from a ServiceLoop) acts on the
+# instance the application actually holds.
+
+_callback_table = {}
+_next_callback_key = itertools.count(1).next
+
+
+def _trampoline(prototype):
+    def trampoline(*args):
+        entry = _callback_table.get(args[-1])
+        if entry is not None:
+            entry[1](entry[0], *args[1:-1])
+    return prototype(trampoline)
+
+
+_domain_enum_trampoline     = _trampoline(_DNSServiceDomainEnumReply)
+_register_trampoline        = _trampoline(_DNSServiceRegisterReply)
+_browse_trampoline          = _trampoline(_DNSServiceBrowseReply)
+_resolve_trampoline         = _trampoline(_DNSServiceResolveReply)
+_register_record_trampoline = _trampoline(_DNSServiceRegisterRecordReply)
+_query_record_trampoline    = _trampoline(_DNSServiceQueryRecordReply)
+
+
 
 ################################################################################
 #
@@ -580,7 +769,8 @@ def _create_function_bindings():
     ERRCHECK    = True
     NO_ERRCHECK = False
 
-    OUTPARAM    = (lambda index: index)
+    OUTPARAM    = (lambda index: (index, 2))
+    INOUTPARAM  = (lambda index: (index, 3))
     NO_OUTPARAM = None
 
     specs = {
@@ -628,7 +818,7 @@ def _create_function_bindings():
         (
             _DNSServiceErrorType,
             ERRCHECK,
-            OUTPARAM(0),
+            INOUTPARAM(0),
             (
                 ctypes.POINTER(DNSServiceRef),	# sdRef
                 _DNSServiceFlags,		# flags
@@ -641,7 +831,7 @@ def _create_function_bindings():
         (
             _DNSServiceErrorType,
             ERRCHECK,
-            OUTPARAM(0),
+            INOUTPARAM(0),
             (
                 ctypes.POINTER(DNSServiceRef),	# sdRef
                 _DNSServiceFlags,		# flags
@@ -701,7 +891,7 @@ def _create_function_bindings():
         (
             _DNSServiceErrorType,
             ERRCHECK,
-            OUTPARAM(0),
+            INOUTPARAM(0),
             (
                 ctypes.POINTER(DNSServiceRef),	# sdRef
                 _DNSServiceFlags,		# flags
@@ -716,7 +906,7 @@ def _create_function_bindings():
         (
             _DNSServiceErrorType,
             ERRCHECK,
-            OUTPARAM(0),
+            INOUTPARAM(0),
             (
                 ctypes.POINTER(DNSServiceRef),	# sdRef
                 _DNSServiceFlags,		# flags
@@ -761,7 +951,7 @@ def _create_function_bindings():
         (
             _DNSServiceErrorType,
             ERRCHECK,
-            OUTPARAM(0),
+            INOUTPARAM(0),
             (
                 ctypes.POINTER(DNSServiceRef),	# sdRef
                 _DNSServiceFlags,		# flags
@@ -803,20 +993,43 @@ def _create_function_bindings():
         }
 
 
-    for name, (restype, errcheck, outparam, argtypes) in specs.iteritems():
-        prototype = _CFunc(restype, *argtypes)
+    for name, spec in specs.iteritems():
+        globals()['_' + name] = _LazyFunction(name, spec)
+
+
+class _LazyFunction(object):
+
+    # Stands in for a function binding until the first time it's
+    # called, at which point the real binding is created and replaces
+    # this object in the module namespace
+
+    def __init__(self, name, spec):
+        self.name = name
+        self.spec = spec
+
+    def __call__(self, *args, **kwargs):
+        return _bind_function(self.name, self.spec)(*args, **kwargs)
 
-        paramflags = [1] * len(argtypes)
-        if outparam is not None:
-            paramflags[outparam] = 2
-        paramflags = tuple((val,) for val in paramflags)
 
-        func = prototype((name, _libdnssd), paramflags)
+def _bind_function(name, spec):
+    load()
 
-        if errcheck:
-            func.errcheck = BonjourError._errcheck
+    restype, errcheck, outparam, argtypes = spec
+    prototype = _CFunc(restype, *argtypes)
 
-        globals()['_' + name] = func
+    paramflags = [1] * len(argtypes)
+    if outparam is not None:
+        index, flag = outparam
+        paramflags[index] = flag
+    paramflags = tuple((val,) for val in paramflags)
+
+    func = prototype((name, _libdnssd), paramflags)
+
+    if errcheck:
+        func.errcheck = BonjourError._errcheck
+
+    globals()['_' + name] = func
+    return func
 
 
 # Only need to do this once
@@ -847,14 +1060,247 @@ _NO_DEFAULT = _NoDefault()
 
 def _string_to_length_and_void_p(string):
     if isinstance(string, TXTRecord):
-        string = str(string)
+        return string._length_and_void_p()
     void_p = ctypes.cast(ctypes.c_char_p(string), ctypes.c_void_p)
     return len(string), void_p
 
 
+try:
+    _buffer = buffer
+except NameError:
+    _buffer = memoryview
+
+
 def _length_and_void_p_to_string(length, void_p):
-    char_p = ctypes.cast(void_p, ctypes.POINTER(ctypes.c_char))
-    return ''.join(char_p[i] for i in xrange(length))
+    if not length:
+        return ''
+    return ctypes.string_at(void_p, length)
+
+
+def _length_and_void_p_to_buffer(length, void_p):
+    # The buffer refers directly to memory owned by the DNS-SD
+    # library, so it's valid only until the callback returns
+    if not length:
+        return _buffer('')
+    return _buffer((ctypes.c_char * length).from_address(void_p))
+
+
+def _share_connection(flags, sdRef):
+    # Returns the flags and the DNSServiceRef to pass as the in/out
+    # sdRef parameter of a DNS-SD call that shares the connection of
+    # sdRef (if it's not None)
+    if sdRef is None:
+        return flags, DNSServiceRef()
+    DNSServiceRef.from_param(sdRef)
+    if sdRef._primary is not None:
+        raise ValueError('cannot share the connection of a DNSServiceRef '
+                         'that is itself sharing one')
+    flags |= kDNSServiceFlagsShareConnection
+    return flags, DNSServiceRef(sdRef.value)
+
+
+def _poll_error_is_eintr():
+    # select.error isn't a subclass of EnvironmentError in Python 2,
+    # so it can't be handled in the same way as IOError
+    return (sys.exc_info()[1].args[0] == errno.EINTR)
+
+
+def _fd_readable(fd, timeout):
+    # Returns True if fd becomes readable within timeout seconds (or
+    # whenever it does, if timeout is None).  poll() is used where
+    # it's available, since select() can't handle descriptors of
+    # FD_SETSIZE (usually 1024) or more.
+    if timeout is not None:
+        deadline = time.time() + timeout
+
+    while True:
+        try:
+            if not hasattr(select, 'poll'):
+                return bool(select.select([fd], [], [], timeout)[0])
+            poller = select.poll()
+            poller.register(fd, select.POLLIN)
+            if timeout is None:
+                return bool(poller.poll())
+            # poll() wants milliseconds; round up so that we never
+            # give up before the timeout has actually expired
+            return bool(poller.poll(int(timeout * 1000.0 + 0.999)))
+        except select.error:
+            if not _poll_error_is_eintr():
+                raise
+            if timeout is not None:
+                timeout = max(0.0, deadline - time.time())
+
+
+def _acquire_for_reply(sdRef, timeout):
+    # Acquires _global_lock once a reply is waiting to be read from
+    # sdRef and returns True, or returns False (without the lock) if
+    # timeout seconds pass first.  Getting the descriptor also ensures
+    # that the library is loaded, so _global_lock is the real thing.
+    # Without a timeout, there's no point in waiting separately
+    # unless it lets us avoid holding a real lock while we block.
+    fd = sdRef.fileno()
+    if (timeout is None) and isinstance(_global_lock, _DummyLock):
+        _global_lock.acquire()
+        return True
+
+    if timeout is not None:
+        deadline = time.time() + timeout
+
+    while True:
+        if not _fd_readable(fd, timeout):
+            return False
+
+        # Another thread may have read the reply before we got the
+        # lock, in which case we'd block in DNSServiceProcessResult()
+        # while holding it, so check again before returning
+        _global_lock.acquire()
+        if _fd_readable(fd, 0):
+            return True
+        _global_lock.release()
+
+        if timeout is not None:
+            timeout = max(0.0, deadline - time.time())
+
+
+def _rdata_to_address(rrtype, rdata):
+    # Convert the rdata of an A or AAAA record to a printable address
+    if rrtype == kDNSServiceType_AAAA:
+        if hasattr(socket, 'inet_ntop'):
+            return socket.inet_ntop(socket.AF_INET6, rdata)
+        return ':'.join(['%x' % val for val in struct.unpack('!8H', rdata)])
+    return socket.inet_ntoa(rdata)
+
+
+try:
+    _intern = intern
+except NameError:
+    _intern = sys.intern
+
+# Canonical copies of the unicode strings passed to _intern_string(),
+# which the builtin intern() doesn't accept.  Only regtypes and
+# domains are interned this way, so the table stays small.
+_interned_strings = {}
+
+
+def _intern_string(string):
+    # Returns a canonical copy of string, so that a string repeated
+    # across many objects (e.g. a regtype or domain) is stored only
+    # once
+    if isinstance(string, str):
+        return _intern(string)
+    return _interned_strings.setdefault(string, string)
+
+
+class _LRUCache(object):
+
+    # A mapping that holds at most maxSize items, discarding the least
+    # recently used ones to stay within that limit.  Items are kept
+    # on a circular doubly-linked list of [prev, next, key, value]
+    # links, most recently used last, so every operation is O(1).
+
+    def __init__(self, maxSize, evicted=None):
+        self.maxSize = maxSize
+        self._evicted = evicted
+        self._map = {}
+        self._root = []
+        self._root[:] = [self._root, self._root, None, None]
+
+    def __len__(self):
+        return len(self._map)
+
+    def __contains__(self, key):
+        return key in self._map
+
+    def __iter__(self):
+        # Least recently used first
+        keys = []
+        link = self._root[1]
+        while link is not self._root:
+            keys.append(link[2])
+            link = link[1]
+        return iter(keys)
+
+    def _unlink(self, link):
+        link[0][1] = link[1]
+        link[1][0] = link[0]
+
+    def _append(self, link):
+        last = self._root[0]
+        link[0] = last
+        link[1] = self._root
+        last[1] = self._root[0] = link
+
+    def get(self, key, default=None):
+        link = self._map.get(key)
+        if link is None:
+            return default
+        self._unlink(link)
+        self._append(link)
+        return link[3]
+
+    def __setitem__(self, key, value):
+        link = self._map.get(key)
+        if link is not None:
+            self._unlink(link)
+            link[3] = value
+        else:
+            link = self._map[key] = [None, None, key, value]
+        self._append(link)
+
+        while len(self._map) > self.maxSize:
+            oldest = self._root[1]
+            self._unlink(oldest)
+            del self._map[oldest[2]]
+            if self._evicted is not None:
+                self._evicted(oldest[2], oldest[3])
+
+    def pop(self, key, default=None):
+        link = self._map.pop(key, None)
+        if link is None:
+            return default
+        self._unlink(link)
+        return link[3]
+
+    def clear(self):
+        for link in self._map.values():
+            del link[:]
+        self._map.clear()
+        self._root[:] = [self._root, self._root, None, None]
+
+
+# Per-thread state of DNSServiceProcessResults()
+_reply_state = threading.local()
+
+
+class _ReplyBatch(object):
+
+    def __init__(self, coalesce):
+        self.flags = 0
+        if coalesce:
+            self.events = []
+        else:
+            self.events = None
+
+
+def _begin_reply_batch(batch):
+    previous = getattr(_reply_state, 'batch', None)
+    _reply_state.batch = batch
+    return previous
+
+
+def _end_reply_batch(previous):
+    _reply_state.batch = previous
+
+
+def _dispatch_reply(callBack, flags, args):
+    batch = getattr(_reply_state, 'batch', None)
+    if batch is not None:
+        batch.flags = flags
+        if batch.events is not None:
+            batch.events.append(args)
+            return
+    if callBack is not None:
+        callBack(*args)
 
 
 
@@ -868,39 +1314,153 @@ def _length_and_void_p_to_string(length, void_p):
 
 def DNSServiceProcessResult(
     sdRef,
+    timeout = None,
     ):
 
     """
 
     Read a reply from the daemon, calling the appropriate application
     callback.  This call will block until the daemon's response is
-    received.  Use sdRef in conjunction with select() or poll() to
-    determine the presence of a response from the server before
-    calling this function to process the reply without blocking.  Call
-    this function at any point if it is acceptable to block until the
-    daemon's response arrives.  Note that the client is responsible
-    for ensuring that DNSServiceProcessResult() is called whenever
-    there is a reply from the daemon; the daemon may terminate its
-    connection with a client that does not process the daemon's
-    responses.
+    received, or until timeout seconds have passed.  Use sdRef in
+    conjunction with select() or poll() to determine the presence of
+    a response from the server before calling this function to process
+    the reply without blocking.  Call this function at any point if it
+    is acceptable to block until the daemon's response arrives.  Note
+    that the client is responsible for ensuring that
+    DNSServiceProcessResult() is called whenever there is a reply from
+    the daemon; the daemon may terminate its connection with a client
+    that does not process the daemon's responses.
+
+    When the global lock is in use (i.e. with Avahi's compatibility
+    layer) or a timeout is given, this function waits for the reply
+    to arrive without holding the lock, so a thread waiting for a
+    slow reply doesn't stall DNS-SD calls made by other threads.
 
       sdRef:
         A DNSServiceRef returned by any of the DNSService calls that
-        take a callback parameter.
+        take a callback parameter.  If it shares a connection created
+        by DNSServiceCreateConnection() (or is that connection),
+        replies for every operation sharing the connection are
+        processed.
+
+      timeout:
+        If not None, the maximum number of seconds to wait for a
+        reply.
+
+      return value:
+        True if a reply was processed, False if the timeout expired
+        first.
 
     """
 
-    _global_lock.acquire()
+    # Replies for DNSServiceRefs sharing a connection are read via
+    # the connection's own DNSServiceRef
+    connection = sdRef._connection()
+
+    if not _acquire_for_reply(connection, timeout):
+        return False
+
+    # A callback may process results on some other DNSServiceRef while
+    # DNSServiceProcessResults() is batching replies on this thread
+    previous = _begin_reply_batch(None)
+    try:
+        _DNSServiceProcessResult(connection)
+    finally:
+        _global_lock.release()
+        _end_reply_batch(previous)
+
+    return True
+
+
+def DNSServiceProcessResults(
+    sdRef,
+    maxBatch = 64,
+    batchCallBack = None,
+    timeout = None,
+    ):
+
+    """
+
+    Read and process replies from the daemon for as long as more are
+    immediately available, up to a limit of maxBatch replies.  Like
+    DNSServiceProcessResult(), this call blocks until the first reply
+    is received or timeout seconds have passed, waiting without
+    holding the global lock where that matters.  After each reply,
+    processing continues if the daemon set kDNSServiceFlagsMoreComing
+    or if another reply is already waiting to be read.  The global
+    lock is acquired once for the whole batch, so draining a burst of
+    replies (e.g. the many browse results that arrive when joining a
+    busy network) costs one wakeup rather than one per reply.
+
+      sdRef:
+        A DNSServiceRef returned by any of the DNSService calls that
+        take a callback parameter.  If it shares a connection created
+        by DNSServiceCreateConnection() (or is that connection),
+        replies for every operation sharing the connection are
+        processed.
+
+      maxBatch:
+        The maximum number of replies to process.
+
+      batchCallBack:
+        If None, the appropriate application callback is invoked for
+        each reply, as with DNSServiceProcessResult().  Otherwise, the
+        application callbacks are NOT invoked; instead, the arguments
+        that would have been passed to them are collected, and
+        batchCallBack(sdRef, events) is called once after the batch
+        has been read, where events is a list containing one tuple of
+        callback arguments per reply.  (Operations created with
+        zeroCopy set must not be processed this way, since their
+        buffers are no longer valid by the time batchCallBack is
+        called.)
+
+      timeout:
+        If not None, the maximum number of seconds to wait for the
+        first reply.
+
+      return value:
+        The number of replies processed (0 if the timeout expired).
+
+    """
+
+    connection = sdRef._connection()
+
+    if not _acquire_for_reply(connection, timeout):
+        return 0
+
+    batch = _ReplyBatch(batchCallBack is not None)
+    processed = 0
+    fd = None
+
+    previous = _begin_reply_batch(batch)
     try:
-        _DNSServiceProcessResult(sdRef)
+        while True:
+            batch.flags = 0
+            _DNSServiceProcessResult(connection)
+            processed += 1
+
+            if (processed >= maxBatch) or (not connection._valid()):
+                break
+            if not (batch.flags & kDNSServiceFlagsMoreComing):
+                if fd is None:
+                    fd = _DNSServiceRefSockFD(connection)
+                if not _fd_readable(fd, 0):
+                    break
     finally:
         _global_lock.release()
+        _end_reply_batch(previous)
+
+    if batch.events:
+        batchCallBack(sdRef, batch.events)
+
+    return processed
 
 
 def DNSServiceEnumerateDomains(
     flags,
     interfaceIndex = kDNSServiceInterfaceIndexAny,
     callBack = None,
+    sdRef = None,
     ):
 
     """
@@ -929,6 +1489,11 @@ def DNSServiceEnumerateDomains(
         asynchronously fails.  Its signature should be
         callBack(sdRef,	flags, interfaceIndex, errorCode, replyDomain).
 
+      sdRef:
+        If not None, a DNSServiceRef returned by
+        DNSServiceCreateConnection(), whose connection the enumeration
+        operation shares.  See DNSServiceRegister() for details.
+
       return value:
         A DNSServiceRef instance.
 
@@ -956,25 +1521,34 @@ def DNSServiceEnumerateDomains(
 
     """
 
-    @_DNSServiceDomainEnumReply
-    def _callback(sdRef, flags, interfaceIndex, errorCode, replyDomain,
-                  context):
-        if callBack is not None:
-            callBack(sdRef, flags, interfaceIndex, errorCode,
-                     replyDomain.decode())
+    def _callback(sdRef, flags, interfaceIndex, errorCode, replyDomain):
+        _dispatch_reply(callBack, flags,
+                        (sdRef, flags, interfaceIndex, errorCode,
+                         replyDomain.decode()))
+
+    flags, ref = _share_connection(flags, sdRef)
+
+    key = _next_callback_key()
+    ref._add_callback(key, _callback)
 
     _global_lock.acquire()
     try:
-        sdRef = _DNSServiceEnumerateDomains(flags,
-                                            interfaceIndex,
-                                            _callback,
-                                            None)
+        try:
+            ref = _DNSServiceEnumerateDomains(ref,
+                                              flags,
+                                              interfaceIndex,
+                                              _domain_enum_trampoline,
+                                              key)
+        except:
+            ref._remove_callback(key)
+            raise
     finally:
         _global_lock.release()
 
-    sdRef._add_callback(_callback)
+    if sdRef is not None:
+        sdRef._add_subordinate(ref)
 
-    return sdRef
+    return ref
 
 
 def DNSServiceRegister(
@@ -987,6 +1561,7 @@ def DNSServiceRegister(
     port = _NO_DEFAULT,
     txtRecord = '',
     callBack = None,
+    sdRef = None,
     ):
 
     """
@@ -1063,10 +1638,20 @@ def DNSServiceRegister(
         None.  The client may still deregister the service at any time
         by closing the returned DNSServiceRef.
 
+      sdRef:
+        If not None, a DNSServiceRef returned by
+        DNSServiceCreateConnection().  The registration then shares
+        that DNSServiceRef's connection to the daemon (i.e.
+        kDNSServiceFlagsShareConnection is added to flags) instead of
+        opening a new one, and its replies are read by processing the
+        connection.  Requires a version of the DNS-SD library that
+        supports shared connections.
+
       return value:
         A DNSServiceRef instance.  The registration will remain active
         indefinitely until the client terminates it by closing the
-        DNSServiceRef.
+        DNSServiceRef (or, if it shares a connection, by closing the
+        connection).
 
     Callback Parameters:
 
@@ -1105,36 +1690,46 @@ def DNSServiceRegister(
 
     port = socket.htons(port)
 
+    flags, ref = _share_connection(flags, sdRef)
+
     if not txtRecord:
         txtLen, txtRecord = 1, '\0'
     else:
         txtLen, txtRecord = _string_to_length_and_void_p(txtRecord)
 
-    @_DNSServiceRegisterReply
-    def _callback(sdRef, flags, errorCode, name, regtype, domain, context):
-        if callBack is not None:
-            callBack(sdRef, flags, errorCode, name.decode(), regtype.decode(),
-                     domain.decode())
+    def _callback(sdRef, flags, errorCode, name, regtype, domain):
+        _dispatch_reply(callBack, flags,
+                        (sdRef, flags, errorCode, name.decode(),
+                         regtype.decode(), domain.decode()))
+
+    key = _next_callback_key()
+    ref._add_callback(key, _callback)
 
     _global_lock.acquire()
     try:
-        sdRef = _DNSServiceRegister(flags,
-                                    interfaceIndex,
-                                    name,
-                                    regtype,
-                                    domain,
-                                    host,
-                                    port,
-                                    txtLen,
-                                    txtRecord,
-                                    _callback,
-                                    None)
+        try:
+            ref = _DNSServiceRegister(ref,
+                                      flags,
+                                      interfaceIndex,
+                                      name,
+                                      regtype,
+                                      domain,
+                                      host,
+                                      port,
+                                      txtLen,
+                                      txtRecord,
+                                      _register_trampoline,
+                                      key)
+        except:
+            ref._remove_callback(key)
+            raise
     finally:
         _global_lock.release()
 
-    sdRef._add_callback(_callback)
+    if sdRef is not None:
+        sdRef._add_subordinate(ref)
 
-    return sdRef
+    return ref
 
 
 def DNSServiceAddRecord(
@@ -1295,7 +1890,7 @@ def DNSServiceRemoveRecord(
     finally:
         _global_lock.release()
 
-    RecordRef._invalidate()
+    sdRef._remove_record_ref(RecordRef)
 
 
 def DNSServiceBrowse(
@@ -1304,6 +1899,7 @@ def DNSServiceBrowse(
     regtype = _NO_DEFAULT,
     domain = None,
     callBack = None,
+    sdRef = None,
     ):
 
     """
@@ -1336,6 +1932,11 @@ def DNSServiceBrowse(
         callBack(sdRef, flags, interfaceIndex, errorCode,
                  serviceName, regtype, replyDomain).
 
+      sdRef:
+        If not None, a DNSServiceRef returned by
+        DNSServiceCreateConnection(), whose connection the browse
+        operation shares.  See DNSServiceRegister() for details.
+
       return value:
         A DNSServiceRef instance.  The browse operation will run
         indefinitely until the client terminates it by closing the
@@ -1390,28 +1991,38 @@ def DNSServiceBrowse(
 
     _NO_DEFAULT.check(regtype)
 
-    @_DNSServiceBrowseReply
     def _callback(sdRef, flags, interfaceIndex, errorCode, serviceName, regtype,
-                  replyDomain, context):
-        if callBack is not None:
-            callBack(sdRef, flags, interfaceIndex, errorCode,
-                     serviceName.decode(), regtype.decode(),
-                     replyDomain.decode())
+                  replyDomain):
+        _dispatch_reply(callBack, flags,
+                        (sdRef, flags, interfaceIndex, errorCode,
+                         serviceName.decode(), regtype.decode(),
+                         replyDomain.decode()))
+
+    flags, ref = _share_connection(flags, sdRef)
+
+    key = _next_callback_key()
+    ref._add_callback(key, _callback)
 
     _global_lock.acquire()
     try:
-        sdRef = _DNSServiceBrowse(flags,
-                                  interfaceIndex,
-                                  regtype,
-                                  domain,
-                                  _callback,
-                                  None)
+        try:
+            ref = _DNSServiceBrowse(ref,
+                                    flags,
+                                    interfaceIndex,
+                                    regtype,
+                                    domain,
+                                    _browse_trampoline,
+                                    key)
+        except:
+            ref._remove_callback(key)
+            raise
     finally:
         _global_lock.release()
 
-    sdRef._add_callback(_callback)
+    if sdRef is not None:
+        sdRef._add_subordinate(ref)
 
-    return sdRef
+    return ref
 
 
 def DNSServiceResolve(
@@ -1421,6 +2032,8 @@ def DNSServiceResolve(
     regtype = _NO_DEFAULT,
     domain = _NO_DEFAULT,
     callBack = None,
+    zeroCopy = False,
+    sdRef = None,
     ):
 
     """
@@ -1471,6 +2084,19 @@ def DNSServiceResolve(
         callBack(sdRef, flags, interfaceIndex, errorCode, fullname,
                  hosttarget, port, txtRecord).
 
+      zeroCopy:
+        If false, the txtRecord passed to the callback is a string
+        copied from the daemon's reply.  If true, it is instead a
+        read-only buffer object that refers directly to the reply
+        data.  This avoids a copy, but the buffer is valid only until
+        the callback returns, so it must not be stored (or delivered
+        via the batchCallBack of DNSServiceProcessResults()).
+
+      sdRef:
+        If not None, a DNSServiceRef returned by
+        DNSServiceCreateConnection(), whose connection the resolve
+        operation shares.  See DNSServiceRegister() for details.
+
       return value:
         A DNSServiceRef instance.  The resolve operation will run
         indefinitely until the client terminates it by closing the
@@ -1504,8 +2130,8 @@ def DNSServiceResolve(
         connections are accepted for this service.
 
       txtRecord:
-        A string containing the service's primary txt record, in
-        standard txt record format.
+        A string (or buffer, if zeroCopy is true) containing the
+        service's primary txt record, in standard txt record format.
 
     """
 
@@ -1514,30 +2140,46 @@ def DNSServiceResolve(
     _NO_DEFAULT.check(regtype)
     _NO_DEFAULT.check(domain)
 
-    @_DNSServiceResolveReply
+    if zeroCopy:
+        _to_string = _length_and_void_p_to_buffer
+    else:
+        _to_string = _length_and_void_p_to_string
+
     def _callback(sdRef, flags, interfaceIndex, errorCode, fullname, hosttarget,
-                  port, txtLen, txtRecord, context):
-        if callBack is not None:
-            port = socket.ntohs(port)
-            txtRecord = _length_and_void_p_to_string(txtLen, txtRecord)
-            callBack(sdRef, flags, interfaceIndex, errorCode, fullname.decode(),
-                     hosttarget.decode(), port, txtRecord)
+                  port, txtLen, txtRecord):
+        port = socket.ntohs(port)
+        txtRecord = _to_string(txtLen, txtRecord)
+        _dispatch_reply(callBack, flags,
+                        (sdRef, flags, interfaceIndex, errorCode,
+                         fullname.decode(), hosttarget.decode(), port,
+                         txtRecord))
+
+    flags, ref = _share_connection(flags, sdRef)
+
+    key = _next_callback_key()
+    ref._add_callback(key, _callback)
 
     _global_lock.acquire()
     try:
-        sdRef = _DNSServiceResolve(flags,
-                                   interfaceIndex,
-                                   name,
-                                   regtype,
-                                   domain,
-                                   _callback,
-                                   None)
+        try:
+            ref = _DNSServiceResolve(ref,
+                                     flags,
+                                     interfaceIndex,
+                                     name,
+                                     regtype,
+                                     domain,
+                                     _resolve_trampoline,
+                                     key)
+        except:
+            ref._remove_callback(key)
+            raise
     finally:
         _global_lock.release()
 
-    sdRef._add_callback(_callback)
+    if sdRef is not None:
+        sdRef._add_subordinate(ref)
 
-    return sdRef
+    return ref
 
 
 def DNSServiceCreateConnection():
@@ -1545,11 +2187,14 @@ def DNSServiceCreateConnection():
     """
 
     Create a connection to the daemon allowing efficient registration
-    of multiple individual records.
+    of multiple individual records.  Services can also be registered
+    over the connection by passing it as the sdRef argument of
+    DNSServiceRegister().
 
       return value:
-        A DNSServiceRef instance.  Closing it severs the connection
-        and deregisters all records registered on this connection.
+        A DNSServiceRef instance.  Closing it severs the connection,
+        deregisters all records registered on this connection, and
+        terminates all operations sharing it.
 
     """
 
@@ -1651,29 +2296,35 @@ def DNSServiceRegisterRecord(
 
     rdlen, rdata = _string_to_length_and_void_p(rdata)
 
-    @_DNSServiceRegisterRecordReply
-    def _callback(sdRef, RecordRef, flags, errorCode, context):
-        if callBack is not None:
-            callBack(sdRef, RecordRef, flags, errorCode)
+    def _callback(sdRef, RecordRef, flags, errorCode):
+        _dispatch_reply(callBack, flags, (sdRef, RecordRef, flags, errorCode))
+
+    # As with DNSServiceRef._add_callback(), the callback is added
+    # before the call, as the reply may be processed before it returns
+    key = _next_callback_key()
+    _callback_table[key] = (sdRef, _callback)
 
     _global_lock.acquire()
     try:
-        RecordRef = _DNSServiceRegisterRecord(sdRef,
-                                              flags,
-                                              interfaceIndex,
-                                              fullname,
-                                              rrtype,
-                                              rrclass,
-                                              rdlen,
-                                              rdata,
-                                              ttl,
-                                              _callback,
-                                              None)
+        try:
+            RecordRef = _DNSServiceRegisterRecord(sdRef,
+                                                  flags,
+                                                  interfaceIndex,
+                                                  fullname,
+                                                  rrtype,
+                                                  rrclass,
+                                                  rdlen,
+                                                  rdata,
+                                                  ttl,
+                                                  _register_record_trampoline,
+                                                  key)
+        except:
+            _callback_table.pop(key, None)
+            raise
     finally:
         _global_lock.release()
 
-    sdRef._add_callback(_callback)
-    sdRef._add_record_ref(RecordRef)
+    sdRef._add_record_ref(RecordRef, key)
 
     return RecordRef
 
@@ -1685,6 +2336,8 @@ def DNSServiceQueryRecord(
     rrtype = _NO_DEFAULT,
     rrclass = kDNSServiceClass_IN,
     callBack = None,
+    zeroCopy = False,
+    sdRef = None,
     ):
 
     """
@@ -1723,6 +2376,16 @@ def DNSServiceQueryRecord(
         callBack(sdRef, flags, interfaceIndex, errorCode, fullname,
                  rrtype, rrclass, rdata, ttl).
 
+      zeroCopy:
+        If true, the rdata passed to the callback is a read-only
+        buffer that refers directly to the reply data rather than a
+        copy of it.  See DNSServiceResolve() for details.
+
+      sdRef:
+        If not None, a DNSServiceRef returned by
+        DNSServiceCreateConnection(), whose connection the query
+        operation shares.  See DNSServiceRegister() for details.
+
       return value:
         A DNSServiceRef instance.  The query operation will run
         indefinitely until the client terminates it by closing the
@@ -1758,7 +2421,8 @@ def DNSServiceQueryRecord(
         kDNSServiceClass_IN).
 
       rdata:
-        A string containing the raw rdata of the resource record.
+        A string (or buffer, if zeroCopy is true) containing the raw
+        rdata of the resource record.
 
       ttl:
         The resource record's time to live, in seconds.
@@ -1768,29 +2432,44 @@ def DNSServiceQueryRecord(
     _NO_DEFAULT.check(fullname)
     _NO_DEFAULT.check(rrtype)
 
-    @_DNSServiceQueryRecordReply
+    if zeroCopy:
+        _to_string = _length_and_void_p_to_buffer
+    else:
+        _to_string = _length_and_void_p_to_string
+
     def _callback(sdRef, flags, interfaceIndex, errorCode, fullname, rrtype,
-                  rrclass, rdlen, rdata, ttl, context):
-        if callBack is not None:
-            rdata = _length_and_void_p_to_string(rdlen, rdata)
-            callBack(sdRef, flags, interfaceIndex, errorCode, fullname.decode(),
-                     rrtype, rrclass, rdata, ttl)
+                  rrclass, rdlen, rdata, ttl):
+        rdata = _to_string(rdlen, rdata)
+        _dispatch_reply(callBack, flags,
+                        (sdRef, flags, interfaceIndex, errorCode,
+                         fullname.decode(), rrtype, rrclass, rdata, ttl))
+
+    flags, ref = _share_connection(flags, sdRef)
+
+    key = _next_callback_key()
+    ref._add_callback(key, _callback)
 
     _global_lock.acquire()
     try:
-        sdRef = _DNSServiceQueryRecord(flags,
-                                       interfaceIndex,
-                                       fullname,
-                                       rrtype,
-                                       rrclass,
-                                       _callback,
-                                       None)
+        try:
+            ref = _DNSServiceQueryRecord(ref,
+                                         flags,
+                                         interfaceIndex,
+                                         fullname,
+                                         rrtype,
+                                         rrclass,
+                                         _query_record_trampoline,
+                                         key)
+        except:
+            ref._remove_callback(key)
+            raise
     finally:
         _global_lock.release()
 
-    sdRef._add_callback(_callback)
+    if sdRef is not None:
+        sdRef._add_subordinate(ref)
 
-    return sdRef
+    return ref
 
 
 def DNSServiceReconfirmRecord(
@@ -1899,95 +2578,2765 @@ def DNSServiceConstructFullName(
 
 ################################################################################
 #
-# TXTRecord class
+# Event loop
 #
 ################################################################################
 
 
 
-class TXTRecord(object):
+class Future(object):
 
     """
 
-    A mapping representing a DNS TXT record.  The TXT record's
-    name=value entries are stored as key/value pairs in the mapping.
-    Although keys can be accessed in a case-insensitive fashion
-    (meaning txt['foo'] and txt['FoO'] refer to the same value), key
-    case is preserved in the wire representation of the record (so
-    txt['FoO'] = 'bar' will generate a FoO=bar entry in the TXT
-    record).  Key order is also preserved, so keys appear in the wire
-    format in the order in which they were created.
-
-    Note that in addition to being valid as a txtRecord parameter to
-    DNSServiceRegister(), a TXTRecord instance can be used in place of
-    a resource record data string (i.e. rdata parameter) with any
-    function that accepts one.
+    The eventual result of an asynchronous operation, such as a
+    one-shot resolve started by ServiceLoop.resolve().  Futures may be
+    completed and waited on from different threads.
 
     """
 
-    def __init__(self, items={}, strict=True):
-        """
-
-        Create a new TXTRecord instance, initializing it with the
-        contents of items.  If strict is true, then strict conformance
-        to the DNS TXT record format will be enforced, and attempts to
-        add a name containing invalid characters or a name/value pair
-        whose wire representation is longer than 255 bytes will raise
-        a ValueError exception.
+    def __init__(self):
+        self._state = None
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+        self._event = threading.Event()
 
-        """
+        # Guards the completion of the future and its list of
+        # callbacks, which are called without it held
+        self._lock = threading.Lock()
 
-        self.strict = strict
-        self._names = []
-        self._items = {}
+    def __repr__(self):
+        return '<%s %s>' % (type(self).__name__, self._state or 'pending')
 
-        for name, value in items.iteritems():
-            self[name] = value
+    def _finish(self, state, result, exception):
+        self._lock.acquire()
+        try:
+            if self._state is not None:
+                return False
 
-    def __contains__(self, name):
-        'Return True if name is a key in the record, False otherwise'
-        return (name.lower() in self._items)
+            self._result = result
+            self._exception = exception
+            self._state = state
 
-    def __iter__(self):
-        'Return an iterator over name/value pairs'
-        for name in self._names:
-            yield self._items[name]
+            callbacks = self._callbacks
+            self._callbacks = None
+        finally:
+            self._lock.release()
 
-    def __len__(self):
-        'Return the number of name/value pairs'
-        return len(self._names)
+        self._event.set()
+        for fn in callbacks:
+            fn(self)
 
-    def __nonzero__(self):
-        'Return False if the record is empty, True otherwise'
-        return bool(self._items)
+        return True
 
-    def __str__(self):
+    def cancel(self):
         """
 
-        Return the wire representation of the TXT record as a string.
-        If self.strict is false, any name/value pair whose wire length
-        if greater than 255 bytes will be truncated to 255 bytes.  If
-        the record is empty, '\\0' is returned.
+        Cancel the operation, closing any DNSServiceRef associated with
+        it.  Returns False if the operation had already completed,
+        True otherwise.
 
         """
 
-        if not self:
-            return '\0'
+        return self._finish('cancelled', None, None)
 
-        parts = []
-        for name, value in self:
-            if value is None:
-                item = name
-            else:
-                item = '%s=%s' % (name, value)
-            if (not self.strict) and (len(item) > 255):
-                item = item[:255]
-            parts.append(chr(len(item)))
-            parts.append(item)
+    def cancelled(self):
+        'Return True if the operation was cancelled, False otherwise'
+        return (self._state == 'cancelled')
 
-        return ''.join(parts)
+    def done(self):
+        'Return True if the operation has completed or been cancelled'
+        return (self._state is not None)
 
-    def __getitem__(self, name):
+    def result(self, timeout=None):
+        """
+
+        Return the result of the operation, waiting up to timeout
+        seconds (or indefinitely, if timeout is None) for it to
+        complete.  If the operation failed, the exception it failed
+        with is raised.  Raises CancelledError if the operation was
+        cancelled, or a BonjourError with error code
+        kDNSServiceErr_Timeout if the wait times out.
+
+        Note that a future that is completed by a ServiceLoop can only
+        make progress while that loop is running, so from the loop's
+        own thread use ServiceLoop.run_until_complete() instead.
+
+        """
+
+        exception = self.exception(timeout)
+        if exception is not None:
+            raise exception
+        return self._result
+
+    def exception(self, timeout=None):
+        """
+
+        Return the exception the operation failed with, or None if it
+        succeeded.  Waits for completion in the same manner as
+        result().
+
+        """
+
+        if self._state is None:
+            self._event.wait(timeout)
+            if self._state is None:
+                raise BonjourError(kDNSServiceErr_Timeout)
+        if self._state == 'cancelled':
+            raise CancelledError()
+        return self._exception
+
+    def add_done_callback(self, fn):
+        """
+
+        Arrange for fn(future) to be called when the operation
+        completes or is cancelled.  If it already has, fn is called
+        immediately.
+
+        """
+
+        self._lock.acquire()
+        try:
+            if self._state is None:
+                self._callbacks.append(fn)
+                return
+        finally:
+            self._lock.release()
+
+        fn(self)
+
+    def set_result(self, result):
+        """
+
+        Complete the operation with the given result.  Has no effect
+        if the operation has already completed or been cancelled.
+
+        """
+
+        self._finish('finished', result, None)
+
+    def set_exception(self, exception):
+        """
+
+        Complete the operation with the given exception.  Has no
+        effect if the operation has already completed or been
+        cancelled.
+
+        """
+
+        self._finish('finished', None, exception)
+
+
+def _chain_future(source, target):
+    # Complete target in the same way as source, unless target is
+    # already done (e.g. cancelled)
+    def copy(source):
+        if target.done():
+            return
+        if source.cancelled():
+            target.cancel()
+        elif source.exception() is not None:
+            target.set_exception(source.exception())
+        else:
+            target.set_result(source.result())
+
+    source.add_done_callback(copy)
+
+
+class _Timer(object):
+
+    def __init__(self, when, func, args):
+        self.when = when
+        self.func = func
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class _SelectPoller(object):
+
+    # select() fails outright if any of its descriptors has been
+    # closed, so the loop must weed out closed DNSServiceRefs first
+    requires_open_fds = True
+
+    def __init__(self):
+        self._fds = set()
+
+    def register(self, fd):
+        self._fds.add(fd)
+
+    def unregister(self, fd):
+        self._fds.discard(fd)
+
+    def poll(self, timeout):
+        if not self._fds:
+            # Some platforms won't select() on nothing at all
+            if timeout:
+                time.sleep(timeout)
+            return []
+        try:
+            return select.select(list(self._fds), [], [], timeout)[0]
+        except select.error:
+            if _poll_error_is_eintr():
+                return []
+            raise
+
+    def close(self):
+        self._fds.clear()
+
+
+class _PollPoller(object):
+
+    requires_open_fds = False
+
+    def __init__(self):
+        self._poll = select.poll()
+
+    def register(self, fd):
+        self._poll.register(fd, select.POLLIN)
+
+    def unregister(self, fd):
+        try:
+            self._poll.unregister(fd)
+        except KeyError:
+            pass
+
+    def poll(self, timeout):
+        if timeout is not None:
+            # poll() wants milliseconds; round up so that we never
+            # wake up before the timeout has actually expired
+            timeout = int(timeout * 1000.0 + 0.999)
+        try:
+            return [fd for (fd, event) in self._poll.poll(timeout)]
+        except select.error:
+            if _poll_error_is_eintr():
+                return []
+            raise
+
+    def close(self):
+        pass
+
+
+class _EpollPoller(object):
+
+    requires_open_fds = False
+
+    def __init__(self):
+        self._epoll = select.epoll()
+
+    def register(self, fd):
+        self._epoll.register(fd, select.EPOLLIN)
+
+    def unregister(self, fd):
+        # If the descriptor has already been closed, the kernel has
+        # removed it from the epoll set for us
+        try:
+            self._epoll.unregister(fd)
+        except (IOError, OSError, ValueError):
+            pass
+
+    def poll(self, timeout):
+        if timeout is None:
+            timeout = -1
+        try:
+            return [fd for (fd, event) in self._epoll.poll(timeout)]
+        except (IOError, OSError):
+            if _poll_error_is_eintr():
+                return []
+            raise
+
+    def close(self):
+        self._epoll.close()
+
+
+def _create_poller():
+    if hasattr(select, 'epoll'):
+        return _EpollPoller()
+    if hasattr(select, 'poll'):
+        return _PollPoller()
+    return _SelectPoller()
+
+
+class ServiceLoop(object):
+
+    """
+
+    An event loop that drives any number of DNSServiceRef instances
+    from a single thread.  Rather than passing every DNSServiceRef to
+    select() and then scanning them all for readiness, the loop keeps
+    an index from file descriptor to DNSServiceRef and waits on the
+    most efficient mechanism the platform provides (epoll, poll, or
+    select, in that order of preference), so each wakeup costs time
+    proportional to the number of ready connections rather than the
+    number of open ones.  Only ready connections are passed to
+    DNSServiceProcessResults(), which drains all the replies each one
+    has waiting.
+
+    DNSServiceRef instances can be added and removed at any time,
+    including from within application callbacks invoked by the loop,
+    e.g.
+
+      loop = ServiceLoop()
+      loop.add(DNSServiceBrowse(regtype='_ftp._tcp', callBack=browse_cb))
+      loop.run()
+
+    where browse_cb() might add the DNSServiceRef returned by
+    DNSServiceResolve() to the same loop, and resolve_cb() might call
+    loop.remove(sdRef, close=True) once it has its answer.
+
+    The loop also runs timed calls (see call_later()) and one-shot
+    operations whose results are delivered through Future instances
+    (see resolve() and query_record()), so that a single thread can
+    drive any number of concurrent operations without blocking on any
+    one of them, e.g.
+
+      future = loop.resolve(interfaceIndex, name, regtype, domain,
+                            timeout=5)
+      interfaceIndex, fullname, hosttarget, port, txtRecord = \\
+          loop.run_until_complete(future)
+
+    Operations that share a connection created by
+    DNSServiceCreateConnection() are driven by watching the
+    connection, so any number of them cost the loop a single file
+    descriptor.  If the loop is created with shareConnection set, its
+    connection attribute is such a connection, which the loop creates
+    (and watches) when first needed and runs its one-shot operations
+    on.  It can also be passed as the sdRef argument of
+    DNSServiceBrowse() etc. to run other operations on it.  (Without
+    shareConnection, the connection attribute is None.)
+
+    A ServiceLoop is not thread safe; all methods other than stop()
+    must be called from the thread running the loop.
+
+    """
+
+    def __init__(self, maxBatch=64, shareConnection=False,
+                 errorCallBack=None):
+        """
+
+        Create a new, empty ServiceLoop.  maxBatch is the maximum
+        number of replies read from any one DNSServiceRef per wakeup
+        (see DNSServiceProcessResults()).  If shareConnection is true,
+        the loop's one-shot operations, and those of the helpers
+        (e.g. ServiceBrowser) that use the loop, share a single
+        connection to the daemon; this requires a version of the
+        DNS-SD library that supports shared connections.
+
+        If processing the replies for a DNSServiceRef fails with a
+        BonjourError (e.g. because the daemon closed the connection),
+        the loop stops watching it, fails the futures of any one-shot
+        operations using it, and carries on serving the others.  If
+        errorCallBack is not None, it is then called as
+        errorCallBack(sdRef, error).  Otherwise, the DNSServiceRef is
+        just dropped; either way, closing it is up to the application,
+        unless it's the loop's own connection, which the loop closes
+        (and replaces when next needed).
+
+        """
+
+        self.maxBatch = maxBatch
+        self.shareConnection = shareConnection
+        self.errorCallBack = errorCallBack
+        self._connection = None
+        self._poller = _create_poller()
+        self._refs = {}
+        self._readers = {}
+        self._timers = []
+        self._timer_seq = 0
+
+        # Maps the id() of the DNSServiceRef of each one-shot
+        # operation to (sdRef, future)
+        self._operations = {}
+
+        self._dispatching = False
+        self._closing = []
+        self._running = False
+
+    def __contains__(self, sdRef):
+        'Return True if sdRef (or the connection it shares) is being watched'
+        return (self._lookup(sdRef._connection()) is not None)
+
+    def __iter__(self):
+        'Return an iterator over the watched DNSServiceRef instances'
+        return iter(list(self._refs.values()))
+
+    def __len__(self):
+        'Return the number of watched DNSServiceRef instances'
+        return len(self._refs)
+
+    def _lookup(self, sdRef):
+        if not sdRef._valid():
+            return None
+        ref = self._refs.get(sdRef.fileno())
+        if (ref is None) or (ref != sdRef):
+            return None
+        return ref
+
+    def _discard(self, fd):
+        del self._refs[fd]
+        self._poller.unregister(fd)
+
+    def _get_connection(self):
+        if not self.shareConnection:
+            return None
+        if (self._connection is None) or (not self._connection._valid()):
+            self._connection = DNSServiceCreateConnection()
+            self.add(self._connection)
+        return self._connection
+
+    connection = property(_get_connection)
+
+    def add(self, sdRef):
+        """
+
+        Start watching sdRef, a DNSServiceRef returned by any of the
+        DNSService calls that take a callback parameter.  Adding a
+        DNSServiceRef that is already being watched has no effect.
+        Adding one that shares a connection starts watching the
+        connection instead.
+
+        """
+
+        sdRef = sdRef._connection()
+        fd = sdRef.fileno()
+
+        ref = self._refs.get(fd)
+        if ref is not None:
+            if ref._valid():
+                if ref == sdRef:
+                    return
+                raise ValueError('file descriptor %d is already in use' % fd)
+            # The old DNSServiceRef was closed without being removed,
+            # and its descriptor has since been reused
+            self._discard(fd)
+
+        self._refs[fd] = sdRef
+        self._poller.register(fd)
+
+    def remove(self, sdRef, close=False):
+        """
+
+        Stop watching sdRef.  If close is true, the DNSServiceRef is
+        also closed.  sdRef is the instance originally passed to add(),
+        which is also the one passed to its application callbacks.
+        Removing a DNSServiceRef that has
+        already been closed is allowed (and has no effect if the loop
+        has already noticed the closure); otherwise, KeyError is
+        raised if sdRef is not being watched.  Removing one that
+        shares a connection leaves the connection watched (since
+        other operations may be using it), so only has an effect if
+        close is true.
+
+        """
+
+        if sdRef._valid() and (sdRef._primary is not None):
+            if close:
+                if self._dispatching:
+                    self._closing.append(sdRef)
+                else:
+                    sdRef.close()
+            return
+
+        if not sdRef._valid():
+            # Already closed, so its descriptor can't be looked up (and
+            # the loop may have dropped it already)
+            for fd, ref in list(self._refs.items()):
+                if ref is sdRef:
+                    self._discard(fd)
+                    break
+            return
+
+        ref = self._lookup(sdRef)
+        if ref is None:
+            raise KeyError(sdRef)
+
+        self._discard(ref.fileno())
+
+        if close:
+            if self._dispatching:
+                # Don't pull the DNSServiceRef out from under
+                # DNSServiceProcessResult()
+                self._closing.append(ref)
+            else:
+                ref.close()
+
+    def add_reader(self, fd, func):
+        """
+
+        Arrange for func() to be called by the loop whenever file
+        descriptor fd (which must not belong to a DNSServiceRef) is
+        ready for reading.
+
+        """
+
+        if (fd in self._refs) or (fd in self._readers):
+            raise ValueError('file descriptor %d is already in use' % fd)
+        self._readers[fd] = func
+        self._poller.register(fd)
+
+    def remove_reader(self, fd):
+        'Stop watching a file descriptor passed to add_reader()'
+        del self._readers[fd]
+        self._poller.unregister(fd)
+
+    def call_later(self, delay, func, *args):
+        """
+
+        Arrange for func(*args) to be called by the loop after delay
+        seconds.  Returns an object whose cancel() method prevents the
+        call from being made.
+
+        """
+
+        timer = _Timer(time.time() + delay, func, args)
+        self._timer_seq += 1
+        heapq.heappush(self._timers, (timer.when, self._timer_seq, timer))
+        return timer
+
+    def _have_timers(self):
+        # Discards cancelled timers from the front of the queue, and
+        # returns True if any timed calls remain to be made
+        timers = self._timers
+        while timers and timers[0][2].cancelled:
+            heapq.heappop(timers)
+        return bool(timers)
+
+    def _next_timeout(self, timeout):
+        if not self._have_timers():
+            return timeout
+
+        delay = max(0.0, self._timers[0][0] - time.time())
+        if (timeout is None) or (delay < timeout):
+            return delay
+        return timeout
+
+    def _run_timers(self):
+        timers = self._timers
+        now = time.time()
+        while timers and (timers[0][0] <= now):
+            timer = heapq.heappop(timers)[2]
+            if not timer.cancelled:
+                timer.func(*timer.args)
+
+    def process(self, timeout=None):
+        """
+
+        Wait up to timeout seconds (or indefinitely, if timeout is
+        None) for replies from the daemon, and call
+        DNSServiceProcessResults() once for each DNSServiceRef that
+        has replies available.  Then make any timed calls that are
+        due.  Returns the number of DNSServiceRef instances processed.
+
+        """
+
+        processed = 0
+
+        if self._poller.requires_open_fds:
+            for fd, sdRef in list(self._refs.items()):
+                if not sdRef._valid():
+                    self._discard(fd)
+
+        for fd in self._poller.poll(self._next_timeout(timeout)):
+            reader = self._readers.get(fd)
+            if reader is not None:
+                reader()
+                continue
+
+            # Earlier callbacks in this pass may have removed or
+            # closed this DNSServiceRef
+            sdRef = self._refs.get(fd)
+            if sdRef is None:
+                continue
+            if not sdRef._valid():
+                self._discard(fd)
+                continue
+
+            self._dispatching = True
+            try:
+                try:
+                    DNSServiceProcessResults(sdRef, self.maxBatch)
+                except BonjourError:
+                    self._discard(fd)
+                    self._failed(sdRef, sys.exc_info()[1])
+            finally:
+                self._dispatching = False
+                closing = self._closing
+                while closing:
+                    closing.pop().close()
+            processed += 1
+
+        self._run_timers()
+
+        return processed
+
+    def _failed(self, sdRef, error):
+        # Called once sdRef, which processing has failed for, has been
+        # discarded
+        for opRef, future in list(self._operations.values()):
+            if opRef._connection() == sdRef:
+                future.set_exception(error)
+
+        if sdRef is self._connection:
+            self._connection = None
+            sdRef.close()
+
+        if self.errorCallBack is not None:
+            self.errorCallBack(sdRef, error)
+
+    def run(self):
+        """
+
+        Process replies and timed calls until stop() is called or
+        there are no more DNSServiceRef instances or file descriptors
+        to watch and no timed calls to make.
+
+        """
+
+        self._running = True
+        try:
+            while self._running and (self._refs or self._readers or
+                                     self._have_timers()):
+                self.process()
+        finally:
+            self._running = False
+
+    def run_until_complete(self, future, timeout=None):
+        """
+
+        Process replies and timed calls until future is done, then
+        return its result (or raise its exception).  If timeout is not
+        None and the future isn't done within timeout seconds, a
+        BonjourError with error code kDNSServiceErr_Timeout is raised
+        (but the future is left running).
+
+        """
+
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+
+        while not future.done():
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise BonjourError(kDNSServiceErr_Timeout)
+            if not (self._refs or self._have_timers()):
+                raise RuntimeError('future cannot complete: nothing to process')
+            self.process(remaining)
+
+        return future.result()
+
+    def stop(self):
+        """
+
+        Cause run() to return after it finishes processing the current
+        batch of replies.
+
+        """
+
+        self._running = False
+
+    def close(self, closeRefs=True):
+        """
+
+        Stop watching all DNSServiceRef instances and release the
+        loop's resources.  If closeRefs is true, the watched
+        DNSServiceRef instances are closed as well.
+
+        """
+
+        refs = list(self._refs.values())
+        self._refs.clear()
+        self._readers.clear()
+        self._poller.close()
+        del self._timers[:]
+        self._operations.clear()
+        self._connection = None
+
+        if closeRefs:
+            for sdRef in refs:
+                sdRef.close()
+
+    def _start_operation(self, future, sdRef, timeout):
+        self.add(sdRef)
+        self._operations[id(sdRef)] = (sdRef, future)
+
+        timer = None
+        if timeout is not None:
+            timer = self.call_later(timeout, future.set_exception,
+                                    BonjourError(kDNSServiceErr_Timeout))
+
+        def finished(future):
+            self._operations.pop(id(sdRef), None)
+            if timer is not None:
+                timer.cancel()
+            if sdRef in self:
+                self.remove(sdRef, close=True)
+            else:
+                sdRef.close()
+
+        future.add_done_callback(finished)
+
+    def resolve(self,
+                interfaceIndex = _NO_DEFAULT,
+                name = _NO_DEFAULT,
+                regtype = _NO_DEFAULT,
+                domain = _NO_DEFAULT,
+                timeout = None,
+                ):
+
+        """
+
+        Start a one-shot DNSServiceResolve() driven by this loop.  The
+        arguments have the same meaning as for DNSServiceResolve().
+        Returns a Future whose result is the tuple
+        (interfaceIndex, fullname, hosttarget, port, txtRecord) from
+        the first successful reply.  The future fails with a
+        BonjourError if the resolve fails or (if timeout is not None)
+        doesn't complete within timeout seconds.  The underlying
+        DNSServiceRef is closed as soon as the future is done,
+        including when it is cancelled.
+
+        """
+
+        future = Future()
+
+        def callback(sdRef, flags, interfaceIndex, errorCode, fullname,
+                     hosttarget, port, txtRecord):
+            if errorCode != kDNSServiceErr_NoError:
+                future.set_exception(BonjourError(errorCode))
+            else:
+                future.set_result((interfaceIndex, fullname, hosttarget, port,
+                                   txtRecord))
+
+        sdRef = DNSServiceResolve(0, interfaceIndex, name, regtype, domain,
+                                  callback, sdRef=self.connection)
+        self._start_operation(future, sdRef, timeout)
+
+        return future
+
+    def query_record(self,
+                     interfaceIndex = kDNSServiceInterfaceIndexAny,
+                     fullname = _NO_DEFAULT,
+                     rrtype = _NO_DEFAULT,
+                     rrclass = kDNSServiceClass_IN,
+                     timeout = None,
+                     ):
+
+        """
+
+        Start a one-shot DNSServiceQueryRecord() driven by this loop.
+        The arguments have the same meaning as for
+        DNSServiceQueryRecord().  Returns a Future whose result is the
+        tuple (interfaceIndex, fullname, rrtype, rrclass, rdata, ttl)
+        from the first reply that adds a record.  Failure, timeout,
+        and cancellation are handled as for resolve().
+
+        """
+
+        future = Future()
+
+        def callback(sdRef, flags, interfaceIndex, errorCode, fullname,
+                     rrtype, rrclass, rdata, ttl):
+            if errorCode != kDNSServiceErr_NoError:
+                future.set_exception(BonjourError(errorCode))
+            elif flags & kDNSServiceFlagsAdd:
+                future.set_result((interfaceIndex, fullname, rrtype, rrclass,
+                                   rdata, ttl))
+
+        sdRef = DNSServiceQueryRecord(0, interfaceIndex, fullname, rrtype,
+                                      rrclass, callback,
+                                      sdRef=self.connection)
+        self._start_operation(future, sdRef, timeout)
+
+        return future
+
+
+class _Waker(object):
+
+    # A descriptor that other threads can make readable in order to
+    # wake up a thread waiting in ServiceLoop.process()
+
+    def __init__(self):
+        if hasattr(socket, 'socketpair'):
+            self._reader, self._writer = socket.socketpair()
+        else:
+            # Windows has neither socketpair() nor selectable pipes
+            listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            try:
+                listener.bind(('127.0.0.1', 0))
+                listener.listen(1)
+                self._writer = socket.socket(socket.AF_INET,
+                                             socket.SOCK_STREAM)
+                self._writer.connect(listener.getsockname())
+                self._reader = listener.accept()[0]
+            finally:
+                listener.close()
+
+        self._reader.setblocking(False)
+        self._writer.setblocking(False)
+
+    def fileno(self):
+        return self._reader.fileno()
+
+    def wake(self):
+        try:
+            self._writer.send('\0')
+        except socket.error:
+            # The buffer is full, so the reader will wake up anyway
+            pass
+
+    def drain(self):
+        try:
+            while self._reader.recv(4096):
+                pass
+        except socket.error:
+            pass
+
+    def close(self):
+        self._reader.close()
+        self._writer.close()
+
+
+class ServiceWorker(object):
+
+    """
+
+    A thread that makes DNS-SD calls on behalf of other threads.
+    Rather than contending for the global lock (which, with Avahi's
+    compatibility layer, serializes every DNS-SD call in the process),
+    threads submit calls to the worker, which executes them in order
+    and returns their results via Future instances, e.g.
+
+      worker = ServiceWorker()
+      sdRef = worker.submit(DNSServiceBrowse, regtype='_ftp._tcp',
+                            callBack=browse_cb).result()
+      ...
+      worker.close_ref(sdRef)
+      worker.stop()
+
+    The worker drives its own ServiceLoop (available as the loop
+    attribute), and every DNSServiceRef returned by a submitted call
+    is added to it.  Consequently, application callbacks for those
+    DNSServiceRefs are invoked on the worker thread, and they may
+    use the loop directly.  DNSServiceRefs owned by the worker should
+    be closed with close_ref() rather than directly.  As with any
+    ServiceLoop, a DNSServiceRef whose replies can't be processed is
+    dropped (and reported to errorCallBack, if given) without
+    affecting the others.  Should the worker thread exit without
+    being stopped, the calls waiting to be executed and the one-shot
+    operations started on the loop fail with RuntimeError, as do
+    later calls to submit().
+
+    Submitting a call doesn't acquire any locks.  Calls queued while
+    the worker is busy are executed together the next time it wakes
+    up.  To make the resulting batching visible, the executed and
+    batches attributes count the calls executed and the number of
+    times the worker woke up to execute them, maxPending records the
+    longest the queue has been, and len(worker) returns the number of
+    calls currently waiting.
+
+    """
+
+    def __init__(self, maxBatch=64, errorCallBack=None):
+        """
+
+        Create a ServiceWorker and start its thread.  maxBatch and
+        errorCallBack are passed to the ServiceLoop constructor.
+
+        """
+
+        self.loop = ServiceLoop(maxBatch, errorCallBack=errorCallBack)
+        self.executed = 0
+        self.batches = 0
+        self.maxPending = 0
+
+        self._queue = collections.deque()
+        self._signalled = False
+        self._stopped = False
+        self._running = True
+        self._waker = _Waker()
+        self.loop.add_reader(self._waker.fileno(), self._execute_pending)
+
+        self._thread = threading.Thread(target=self._run,
+                                        name='pybonjour-worker')
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def __len__(self):
+        'Return the number of submitted calls waiting to be executed'
+        return len(self._queue)
+
+    def submit(self, func, *args, **kwargs):
+        """
+
+        Arrange for func(*args, **kwargs) to be called on the worker
+        thread, and return a Future for its result.  Cancelling the
+        future before the call is made prevents it from being made.
+
+        """
+
+        if self._stopped:
+            raise RuntimeError('worker has been stopped')
+        if not self._running:
+            raise RuntimeError('worker thread has exited')
+
+        return self._submit(func, args, kwargs)
+
+    def _submit(self, func, args, kwargs):
+        future = Future()
+        self._queue.append((future, func, args, kwargs))
+
+        # The worker clears the flag before it empties the queue, so
+        # if the flag is still set, our call will be seen
+        if not self._signalled:
+            self._signalled = True
+            self._waker.wake()
+
+        # If the thread exited meanwhile, it may have missed our call
+        if not self._running:
+            self._fail_pending()
+
+        return future
+
+    def _fail_pending(self):
+        error = RuntimeError('worker thread has exited')
+        while True:
+            try:
+                future = self._queue.popleft()[0]
+            except IndexError:
+                break
+            future.set_exception(error)
+
+    def _run(self):
+        try:
+            self.loop.run()
+        finally:
+            self._running = False
+            if not self._stopped:
+                error = RuntimeError('worker thread has exited')
+                for sdRef, future in list(self.loop._operations.values()):
+                    future.set_exception(error)
+                self._fail_pending()
+
+    def _execute_pending(self):
+        self._waker.drain()
+        self._signalled = False
+
+        queue = self._queue
+        self.batches += 1
+        self.maxPending = max(self.maxPending, len(queue))
+
+        while queue:
+            future, func, args, kwargs = queue.popleft()
+            if future.done():
+                continue
+
+            try:
+                result = func(*args, **kwargs)
+            except Exception:
+                future.set_exception(sys.exc_info()[1])
+            else:
+                if isinstance(result, DNSServiceRef):
+                    self.loop.add(result)
+                future.set_result(result)
+
+            self.executed += 1
+
+    def _close_ref(self, sdRef):
+        if sdRef in self.loop:
+            self.loop.remove(sdRef, close=True)
+        else:
+            sdRef.close()
+
+    def close_ref(self, sdRef):
+        """
+
+        Close sdRef, which should be a DNSServiceRef returned by a call
+        submitted to the worker, on the worker thread.  Returns a
+        Future that is done once the DNSServiceRef has been closed.
+
+        """
+
+        return self.submit(self._close_ref, sdRef)
+
+    def stop(self, closeRefs=True):
+        """
+
+        Stop the worker thread, waiting for it to execute the calls
+        submitted before stop() was called.  If closeRefs is true, all
+        DNSServiceRefs owned by the worker are closed.
+
+        """
+
+        if self._stopped:
+            return
+
+        self._stopped = True
+        if self._running:
+            self._submit(self.loop.stop, (), {})
+        self._thread.join()
+
+        # Calls submitted by other threads while we were stopping
+        # will never be made
+        while self._queue:
+            self._queue.popleft()[0].cancel()
+
+        self.loop.close(closeRefs)
+        self._waker.close()
+
+
+
+################################################################################
+#
+# Service discovery helpers
+#
+################################################################################
+
+
+
+class ServiceInstance(tuple):
+
+    """
+
+    A discovered service instance, as a (name, regtype, domain) tuple
+    whose elements are also available as attributes.  regtype and
+    domain are interned, so that the many instances of a service share
+    a single copy of each, and instances have no __dict__, so they
+    take no more memory than a plain tuple.  A ServiceInstance
+    compares and hashes equal to the corresponding plain tuple.
+
+    """
+
+    __slots__ = ()
+
+    def __new__(cls, name, regtype, domain):
+        return tuple.__new__(cls, (name, _intern_string(regtype),
+                                   _intern_string(domain)))
+
+    def __reduce__(self):
+        return (self.__class__, tuple(self))
+
+    def __repr__(self):
+        return 'ServiceInstance(%r, %r, %r)' % self
+
+    name = property(operator.itemgetter(0), doc='The instance name')
+    regtype = property(operator.itemgetter(1), doc='The service type')
+    domain = property(operator.itemgetter(2), doc='The domain')
+
+
+class ServiceBrowser(object):
+
+    """
+
+    Browse for instances of a service, maintaining a live table of the
+    instances currently available.  Each instance is identified by its
+    (name, regtype, domain) tuple, as reported to the DNSServiceBrowse()
+    callback and stored as a ServiceInstance, and the browser keeps
+    track of the set of interfaces on which each instance has been
+    seen, e.g.
+
+      browser = ServiceBrowser('_ftp._tcp', loop=loop)
+      ...
+      if ('My Server', '_ftp._tcp.', 'local.') in browser:
+          ...
+      for name, regtype, domain in browser:
+          ...
+
+    Lookups take constant time, and iteration is over a snapshot, so
+    the table may change during iteration.  The browse operation runs
+    until close() is called; ServiceBrowser supports the 'with'
+    statement in the same manner as DNSServiceRef.
+
+    """
+
+    def __init__(self,
+                 regtype,
+                 domain = None,
+                 interfaceIndex = kDNSServiceInterfaceIndexAny,
+                 callBack = None,
+                 loop = None,
+                 ):
+
+        """
+
+        Start browsing for instances of regtype.  domain and
+        interfaceIndex have the same meaning as for
+        DNSServiceBrowse().
+
+        If callBack is not None, it is called as
+        callBack(sdRef, flags, interfaceIndex, errorCode, serviceName,
+                 regtype, replyDomain)
+        whenever an instance is added to the table (i.e. is seen on
+        its first interface) or removed from it (i.e. is no longer
+        seen on any interface), as well as when the browse fails.
+        Additions and removals on further interfaces only update the
+        table.
+
+        If loop is not None, the browser's DNSServiceRef (available
+        as the sdRef attribute) is added to that ServiceLoop, sharing
+        the loop's connection if it has one.  Otherwise, the
+        application must process its results in the usual way.
+
+        """
+
+        self._callBack = callBack
+        self._loop = loop
+
+        # Most instances are seen on a single interface, so an entry
+        # holds just that interface's index until a second one is
+        # added, at which point it becomes a set
+        self._instances = {}
+
+        connection = None
+        if loop is not None:
+            connection = loop.connection
+
+        self.sdRef = DNSServiceBrowse(interfaceIndex=interfaceIndex,
+                                      regtype=regtype,
+                                      domain=domain,
+                                      callBack=self._browse_callback,
+                                      sdRef=connection)
+        if loop is not None:
+            loop.add(self.sdRef)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def __contains__(self, instance):
+        'Return True if instance, a (name, regtype, domain) tuple, is available'
+        return (instance in self._instances)
+
+    def __getitem__(self, instance):
+        """
+
+        Return a frozenset containing the indexes of the interfaces on
+        which instance has been seen.  Raises KeyError if instance
+        isn't available.
+
+        """
+
+        interfaces = self._instances[instance]
+        if isinstance(interfaces, set):
+            return frozenset(interfaces)
+        return frozenset((interfaces,))
+
+    def __iter__(self):
+        'Return an iterator over a snapshot of the available instances'
+        return iter(list(self._instances.keys()))
+
+    def __len__(self):
+        'Return the number of available instances'
+        return len(self._instances)
+
+    def _browse_callback(self, sdRef, flags, interfaceIndex, errorCode,
+                         serviceName, regtype, replyDomain):
+        if errorCode == kDNSServiceErr_NoError:
+            instance = ServiceInstance(serviceName, regtype, replyDomain)
+            if flags & kDNSServiceFlagsAdd:
+                changed = self._add(instance, interfaceIndex)
+            else:
+                changed = self._remove(instance, interfaceIndex)
+            if not changed:
+                return
+
+        if self._callBack is not None:
+            self._callBack(sdRef, flags, interfaceIndex, errorCode,
+                           serviceName, regtype, replyDomain)
+
+    def _add(self, instance, interfaceIndex):
+        instances = self._instances
+        interfaces = instances.get(instance)
+
+        if interfaces is None:
+            instances[instance] = interfaceIndex
+            return True
+
+        if isinstance(interfaces, set):
+            interfaces.add(interfaceIndex)
+        elif interfaces != interfaceIndex:
+            instances[instance] = set((interfaces, interfaceIndex))
+        return False
+
+    def _remove(self, instance, interfaceIndex):
+        instances = self._instances
+        interfaces = instances.get(instance)
+
+        if interfaces is None:
+            return False
+
+        if isinstance(interfaces, set):
+            interfaces.discard(interfaceIndex)
+            if len(interfaces) == 1:
+                instances[instance] = interfaces.pop()
+            return False
+
+        if interfaces != interfaceIndex:
+            return False
+        del instances[instance]
+        return True
+
+    def close(self):
+        """
+
+        Terminate the browse operation.  The table is left as it was.
+
+        """
+
+        if (self._loop is not None) and (self.sdRef in self._loop):
+            self._loop.remove(self.sdRef)
+        self.sdRef.close()
+
+
+def resolve_many(instances, concurrency=16, deadline=None, loop=None):
+
+    """
+
+    Resolve many service instances at once, with up to concurrency
+    resolves in progress at any time, and return when they're all
+    done or (if deadline is not None) after deadline seconds,
+    whichever comes first.  concurrency must be at least 1.  Each
+    item of instances is a tuple (interfaceIndex, name, regtype,
+    domain) or, as produced by iterating over a ServiceBrowser,
+    (name, regtype, domain), which is resolved on all interfaces.
+    Each resolve's DNSServiceRef is closed as soon as it produces an
+    answer.
+
+    The resolves are run on loop, if it's not None, or else on a
+    private ServiceLoop.  Returns the tuple (results, errors,
+    timeouts), where results is a dictionary mapping each instance
+    that was resolved to the tuple (interfaceIndex, fullname,
+    hosttarget, port, txtRecord), errors is a dictionary mapping each
+    instance that failed to resolve to the BonjourError describing
+    the failure, and timeouts is a list of the instances that hadn't
+    been resolved when the deadline passed.
+
+    """
+
+    if concurrency < 1:
+        raise ValueError('concurrency must be at least 1')
+
+    if loop is None:
+        ownLoop = True
+        loop = ServiceLoop()
+    else:
+        ownLoop = False
+
+    if deadline is not None:
+        deadline = time.time() + deadline
+
+    instances = list(instances)
+    queue = collections.deque(instances)
+    results = {}
+    errors = {}
+    active = {}
+    finished = []
+
+    def done_callback(instance):
+        def done(future):
+            finished.append((instance, future))
+        return done
+
+    try:
+        while True:
+            while finished:
+                instance, future = finished.pop()
+                del active[instance]
+                if future.exception() is None:
+                    results[instance] = future.result()
+                else:
+                    errors[instance] = future.exception()
+
+            while queue and (len(active) < concurrency):
+                instance = queue.popleft()
+                if (instance in active) or (instance in results) or \
+                   (instance in errors):
+                    continue
+
+                if len(instance) == 3:
+                    args = (kDNSServiceInterfaceIndexAny,) + tuple(instance)
+                else:
+                    args = tuple(instance)
+
+                try:
+                    future = loop.resolve(*args)
+                except BonjourError:
+                    errors[instance] = sys.exc_info()[1]
+                    continue
+
+                active[instance] = future
+                future.add_done_callback(done_callback(instance))
+
+            if not (queue or active):
+                break
+
+            timeout = None
+            if deadline is not None:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+
+            loop.process(timeout)
+    finally:
+        for future in active.values():
+            future.cancel()
+        if ownLoop:
+            loop.close()
+
+    timeouts = []
+    seen = set()
+    for instance in instances:
+        if not ((instance in results) or (instance in errors) or
+                (instance in seen)):
+            timeouts.append(instance)
+            seen.add(instance)
+
+    return results, errors, timeouts
+
+
+def register_many(entries, sdRef=None, timeout=None, callBack=None):
+
+    """
+
+    Register a batch of services over a single connection to the
+    daemon, rather than opening one connection per service, and wait
+    for all of the registrations to complete.  Each item of entries
+    is a tuple (name, regtype, port) or (name, regtype, port,
+    txtRecord), whose elements have the same meaning as the
+    corresponding arguments of DNSServiceRegister().
+
+    If sdRef is None, a new connection is created with
+    DNSServiceCreateConnection(); otherwise, sdRef must be such a
+    connection.  If timeout is not None, this function waits at most
+    timeout seconds for the registrations to complete.  If callBack
+    is not None, it is called (with the signature of a
+    DNSServiceRegister() callback) for every reply to any of the
+    registrations, including those that arrive when the application
+    processes the connection later on.
+
+    Returns the tuple (sdRef, outcomes), where sdRef is the
+    connection and outcomes is a list containing one tuple
+    (sdRef, errorCode, name, regtype, domain) per entry, in order.
+    For a successful registration, sdRef is the registration's own
+    DNSServiceRef (which can be closed to deregister just that
+    service), and name and domain are as registered.  For a failed
+    one, sdRef is None and errorCode indicates the failure.  A
+    registration that hasn't completed when the timeout expires is
+    left in progress and reported with error code
+    kDNSServiceErr_Timeout.  Closing the connection deregisters all
+    of the services.
+
+    """
+
+    if sdRef is None:
+        connection = DNSServiceCreateConnection()
+    else:
+        connection = sdRef
+
+    entries = list(entries)
+    outcomes = [None] * len(entries)
+    refs = [None] * len(entries)
+    waiting = set()
+
+    def register_callback(index):
+        def callback(sdRef, flags, errorCode, name, regtype, domain):
+            if index in waiting:
+                waiting.discard(index)
+                if errorCode == kDNSServiceErr_NoError:
+                    outcomes[index] = (refs[index], errorCode, name, regtype,
+                                       domain)
+                else:
+                    refs[index].close()
+                    outcomes[index] = (None, errorCode, name, regtype,
+                                       domain)
+            if callBack is not None:
+                callBack(sdRef, flags, errorCode, name, regtype, domain)
+        return callback
+
+    if timeout is not None:
+        deadline = time.time() + timeout
+
+    try:
+        for index, entry in enumerate(entries):
+            name, regtype, port = entry[:3]
+            txtRecord = ''
+            if len(entry) > 3:
+                txtRecord = entry[3]
+
+            try:
+                refs[index] = DNSServiceRegister(
+                    name=name, regtype=regtype, port=port,
+                    txtRecord=txtRecord, callBack=register_callback(index),
+                    sdRef=connection)
+            except BonjourError:
+                outcomes[index] = (None, sys.exc_info()[1].errorCode, name,
+                                   regtype, None)
+                continue
+
+            waiting.add(index)
+
+        while waiting:
+            remaining = None
+            if timeout is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+            DNSServiceProcessResults(connection, timeout=remaining)
+    except:
+        if sdRef is None:
+            connection.close()
+        raise
+
+    for index in waiting:
+        name, regtype = entries[index][:2]
+        outcomes[index] = (refs[index], kDNSServiceErr_Timeout, name, regtype,
+                           None)
+    waiting.clear()
+
+    return connection, outcomes
+
+
+class _AddressLookup(object):
+
+    # Looks up the addresses of a resolved service instance's target
+    # host on behalf of a DiscoveryPipeline
+
+    def __init__(self, pipeline, instance, resolved):
+        self.pipeline = pipeline
+        self.instance = instance
+        self.resolved = resolved
+        self.addresses = []
+
+        interfaceIndex, fullname, hosttarget, port, txtRecord = resolved
+        loop = pipeline.loop
+
+        self.futures = []
+        for rrtype in pipeline.rrtypes:
+            try:
+                future = loop.query_record(interfaceIndex, hosttarget, rrtype,
+                                           timeout=pipeline.timeout)
+            except BonjourError:
+                continue
+            self.futures.append(future)
+        self.remaining = len(self.futures)
+
+        for future in self.futures:
+            future.add_done_callback(self._query_done)
+
+    def _query_done(self, future):
+        self.remaining -= 1
+
+        if (not future.cancelled()) and (future.exception() is None):
+            interfaceIndex, fullname, rrtype, rrclass, rdata, ttl = \
+                future.result()
+            if not self.addresses:
+                # Once the host has one address, don't wait long for
+                # the others (which may never arrive)
+                for other in self.futures:
+                    if not other.done():
+                        self.pipeline.loop.call_later(self.pipeline.grace,
+                                                      other.cancel)
+            self.addresses.append(_rdata_to_address(rrtype, rdata))
+
+        if self.remaining == 0:
+            self.pipeline._lookup_done(self)
+
+
+class DiscoveryPipeline(object):
+
+    """
+
+    Browse for instances of a service, resolve each instance found,
+    and look up the addresses of its target host, all on a single
+    ServiceLoop.  Each stage runs its operations concurrently, up to
+    a configurable limit, so a slow resolve or lookup never holds up
+    the others, and each fully resolved instance is passed to the
+    application as soon as its addresses are known, e.g.
+
+      def found(interfaceIndex, serviceName, regtype, replyDomain,
+                hosttarget, port, txtRecord, addresses):
+          ...
+
+      loop = ServiceLoop()
+      pipeline = DiscoveryPipeline(loop, '_http._tcp', found)
+      loop.run()
+
+    Instances that fail to resolve, or whose host has no address
+    within the timeout, are counted in the failures attribute and
+    otherwise ignored.  Work for an instance that goes away is
+    cancelled.
+
+    """
+
+    def __init__(self,
+                 loop,
+                 regtype,
+                 callBack,
+                 domain = None,
+                 interfaceIndex = kDNSServiceInterfaceIndexAny,
+                 resolveConcurrency = 16,
+                 lookupConcurrency = 16,
+                 rrtypes = (kDNSServiceType_A, kDNSServiceType_AAAA),
+                 timeout = 5,
+                 grace = 0.25,
+                 ):
+
+        """
+
+        Start browsing for instances of regtype on loop.  domain and
+        interfaceIndex have the same meaning as for
+        DNSServiceBrowse().
+
+        callBack is called as
+        callBack(interfaceIndex, serviceName, regtype, replyDomain,
+                 hosttarget, port, txtRecord, addresses)
+        for each instance discovered, where addresses is a list of
+        printable addresses of the target host.
+
+        resolveConcurrency limits the number of resolves in progress
+        at once, and lookupConcurrency the number of hosts whose
+        addresses are being looked up at once.  A record of each type
+        in rrtypes is queried for each host.  timeout limits the
+        time, in seconds, allowed for each resolve and query, and once
+        one address has been found for a host, grace limits the
+        additional time allowed for its remaining queries.
+
+        """
+
+        self.loop = loop
+        self.rrtypes = tuple(rrtypes)
+        self.resolveConcurrency = resolveConcurrency
+        self.lookupConcurrency = lookupConcurrency
+        self.timeout = timeout
+        self.grace = grace
+        self.failures = 0
+
+        self._callBack = callBack
+        self._queued = {}
+        self._resolve_queue = collections.deque()
+        self._lookup_queue = collections.deque()
+        self._resolving = 0
+        self._looking_up = 0
+
+        # Maps each instance with work in progress to its outstanding
+        # futures
+        self._futures = {}
+
+        self.browser = ServiceBrowser(regtype, domain, interfaceIndex,
+                                      self._browse_callback, loop)
+
+    def _browse_callback(self, sdRef, flags, interfaceIndex, errorCode,
+                         serviceName, regtype, replyDomain):
+        if errorCode != kDNSServiceErr_NoError:
+            return
+
+        instance = (serviceName, regtype, replyDomain)
+
+        if flags & kDNSServiceFlagsAdd:
+            if instance not in self._queued:
+                self._resolve_queue.append(instance)
+            self._queued[instance] = interfaceIndex
+            self._start_resolves()
+        else:
+            self._queued.pop(instance, None)
+            for future in self._futures.pop(instance, ()):
+                future.cancel()
+
+    def _start_resolves(self):
+        while ((self._resolving < self.resolveConcurrency) and
+               self._resolve_queue):
+            instance = self._resolve_queue.popleft()
+            interfaceIndex = self._queued.pop(instance, None)
+            if (interfaceIndex is None) or (instance in self._futures):
+                continue
+
+            name, regtype, domain = instance
+            try:
+                future = self.loop.resolve(interfaceIndex, name, regtype,
+                                           domain, self.timeout)
+            except BonjourError:
+                self.failures += 1
+                continue
+
+            self._resolving += 1
+            self._futures[instance] = [future]
+            future.add_done_callback(self._resolve_done_callback(instance))
+
+    def _resolve_done_callback(self, instance):
+        def resolve_done(future):
+            self._resolving -= 1
+
+            if not future.cancelled():
+                if future.exception() is None:
+                    self._lookup_queue.append((instance, future.result()))
+                else:
+                    self.failures += 1
+                    self._futures.pop(instance, None)
+
+            self._start_resolves()
+            self._start_lookups()
+
+        return resolve_done
+
+    def _start_lookups(self):
+        while ((self._looking_up < self.lookupConcurrency) and
+               self._lookup_queue):
+            instance, resolved = self._lookup_queue.popleft()
+            if instance not in self._futures:
+                # Went away while waiting
+                continue
+
+            self._looking_up += 1
+            lookup = _AddressLookup(self, instance, resolved)
+            if lookup.remaining:
+                self._futures[instance] = lookup.futures
+            else:
+                self._lookup_done(lookup)
+
+    def _lookup_done(self, lookup):
+        self._looking_up -= 1
+
+        instance = lookup.instance
+        if self._futures.pop(instance, None) is not None:
+            if lookup.addresses:
+                interfaceIndex, fullname, hosttarget, port, txtRecord = \
+                    lookup.resolved
+                name, regtype, domain = instance
+                self._callBack(interfaceIndex, name, regtype, domain,
+                               hosttarget, port, txtRecord, lookup.addresses)
+            else:
+                self.failures += 1
+
+        self._start_lookups()
+
+    def close(self):
+        """
+
+        Stop browsing and cancel all resolves and lookups in progress.
+
+        """
+
+        self.browser.close()
+        self._queued.clear()
+        self._resolve_queue.clear()
+        self._lookup_queue.clear()
+
+        futures = self._futures
+        self._futures = {}
+        for pending in futures.values():
+            for future in pending:
+                future.cancel()
+
+
+class ResolveCache(object):
+
+    """
+
+    A cache of the results of resolving service instances, for
+    applications that resolve the same instances repeatedly.
+    Resolves are run on a ServiceLoop via ServiceLoop.resolve(), and
+    their results are reused until they expire (after ttl seconds,
+    since the DNS-SD library doesn't report a TTL for resolves) or
+    the instance is removed.  At most maxEntries results are kept;
+    beyond that, the least recently used are discarded.  Concurrent
+    requests for an instance that isn't cached share a single
+    resolve.
+
+    Failures are cached too: if resolving an instance fails with one
+    of the error codes in negativeErrorCodes (by default, those
+    meaning that the instance doesn't exist or didn't answer in
+    time), further requests for it fail immediately with the same
+    error for holdDown seconds, or until a browse reports that the
+    instance has (re)appeared.
+
+    The cache learns of instances appearing and going away through
+    browse_callback(), which has the signature of a DNSServiceBrowse()
+    callback, so it can be passed directly as the callBack of
+    DNSServiceBrowse() or ServiceBrowser, or called from the
+    application's own browse callback, e.g.
+
+      cache = ResolveCache(loop)
+      browser = ServiceBrowser('_http._tcp', callBack=cache.browse_callback,
+                               loop=loop)
+      ...
+      future = cache.resolve(interfaceIndex, name, regtype, domain)
+
+    The hits and misses attributes count the requests that were and
+    weren't answered from the cache, and negativeHits counts those
+    that failed because of a cached failure.
+
+    """
+
+    negativeErrorCodes = frozenset([kDNSServiceErr_NoSuchName,
+                                    kDNSServiceErr_NoSuchRecord,
+                                    kDNSServiceErr_Timeout])
+
+    def __init__(self, loop, ttl=60, maxEntries=1024, holdDown=5):
+        self.loop = loop
+        self.ttl = ttl
+        self.holdDown = holdDown
+        self.hits = 0
+        self.misses = 0
+        self.negativeHits = 0
+
+        # Maps (interfaceIndex, name, regtype, domain) to
+        # (expiry time, result)
+        self._entries = _LRUCache(maxEntries, self._evicted)
+
+        # Maps (name, regtype, domain) to the set of keys of its
+        # entries, so removing an instance needn't scan the cache
+        self._instances = {}
+
+        # Maps keys to the futures of resolves in progress
+        self._pending = {}
+
+        # Maps (name, regtype, domain) to a dictionary mapping
+        # interface indexes to (expiry time, error code)
+        self._failures = _LRUCache(maxEntries)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _get_maxEntries(self):
+        return self._entries.maxSize
+
+    def _set_maxEntries(self, maxEntries):
+        self._entries.maxSize = maxEntries
+        self._failures.maxSize = maxEntries
+
+    maxEntries = property(_get_maxEntries, _set_maxEntries)
+
+    def _evicted(self, key, entry):
+        keys = self._instances.get(key[1:])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._instances[key[1:]]
+
+    def get(self,
+            interfaceIndex = _NO_DEFAULT,
+            name = _NO_DEFAULT,
+            regtype = _NO_DEFAULT,
+            domain = _NO_DEFAULT,
+            ):
+
+        """
+
+        Return the cached result of resolving the specified instance,
+        as the tuple (interfaceIndex, fullname, hosttarget, port,
+        txtRecord), or None if there isn't an unexpired one.  Doesn't
+        affect the hit and miss counts.
+
+        """
+
+        key = (interfaceIndex, name, regtype, domain)
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= time.time():
+            self._entries.pop(key)
+            self._evicted(key, entry)
+            return None
+        return entry[1]
+
+    def resolve(self,
+                interfaceIndex = _NO_DEFAULT,
+                name = _NO_DEFAULT,
+                regtype = _NO_DEFAULT,
+                domain = _NO_DEFAULT,
+                timeout = None,
+                ):
+
+        """
+
+        Resolve the specified instance, using the cached result if
+        there is one.  The arguments and the returned Future are the
+        same as for ServiceLoop.resolve().  Cancelling the future
+        doesn't affect other requests for the same instance.
+
+        """
+
+        future = Future()
+
+        result = self.get(interfaceIndex, name, regtype, domain)
+        if result is not None:
+            self.hits += 1
+            future.set_result(result)
+            return future
+
+        errorCode = self._failure(interfaceIndex, name, regtype, domain)
+        if errorCode is not None:
+            self.negativeHits += 1
+            future.set_exception(BonjourError(errorCode))
+            return future
+
+        self.misses += 1
+        key = (interfaceIndex, name, regtype, domain)
+
+        source = self._pending.get(key)
+        if source is None:
+            source = self.loop.resolve(interfaceIndex, name, regtype, domain,
+                                       timeout)
+            self._pending[key] = source
+            source.add_done_callback(self._resolve_done_callback(key))
+
+        _chain_future(source, future)
+        return future
+
+    def _resolve_done_callback(self, key):
+        def resolve_done(future):
+            if self._pending.get(key) is not future:
+                # Invalidated while in progress
+                return
+            del self._pending[key]
+
+            if future.cancelled():
+                return
+
+            exception = future.exception()
+            if exception is None:
+                self._entries[key] = (time.time() + self.ttl, future.result())
+                self._instances.setdefault(key[1:], set()).add(key)
+            elif (self.holdDown and
+                  isinstance(exception, BonjourError) and
+                  (exception.errorCode in self.negativeErrorCodes)):
+                failures = self._failures.get(key[1:])
+                if failures is None:
+                    failures = self._failures[key[1:]] = {}
+                failures[key[0]] = (time.time() + self.holdDown,
+                                    exception.errorCode)
+
+        return resolve_done
+
+    def _failure(self, interfaceIndex, name, regtype, domain):
+        # Returns the error code of an unexpired cached failure, or
+        # None
+        failures = self._failures.get((name, regtype, domain))
+        if failures is None:
+            return None
+        failure = failures.get(interfaceIndex)
+        if failure is None:
+            return None
+        if failure[0] <= time.time():
+            del failures[interfaceIndex]
+            return None
+        return failure[1]
+
+    def invalidate(self, name, regtype, domain):
+        """
+
+        Discard all cached results for the specified instance, on
+        every interface.  Results of resolves already in progress
+        won't be cached.
+
+        """
+
+        instance = (name, regtype, domain)
+        for key in self._instances.pop(instance, ()):
+            self._entries.pop(key)
+        for key in list(self._pending):
+            if key[1:] == instance:
+                del self._pending[key]
+
+    def browse_callback(self, sdRef, flags, interfaceIndex, errorCode,
+                        serviceName, regtype, replyDomain):
+        """
+
+        Update the cache in response to a DNSServiceBrowse() reply.
+
+        """
+
+        if errorCode != kDNSServiceErr_NoError:
+            return
+
+        if flags & kDNSServiceFlagsAdd:
+            self._failures.pop((serviceName, regtype, replyDomain))
+        else:
+            self.invalidate(serviceName, regtype, replyDomain)
+
+    def clear(self):
+        """
+
+        Discard all cached results.
+
+        """
+
+        self._entries.clear()
+        self._instances.clear()
+        self._pending.clear()
+        self._failures.clear()
+
+
+def _name_key(name):
+    # Domain names are compared without regard to case or a trailing
+    # dot
+    return name.lower().rstrip('.')
+
+
+class AddressCache(object):
+
+    """
+
+    A cache of host addresses, for applications that look up the
+    addresses of the same hosts (typically the targets of resolved
+    services) repeatedly.  Addresses are learned from the A and AAAA
+    records delivered to DNSServiceQueryRecord() callbacks, and each
+    is kept for the TTL reported with it.
+
+    lookup() answers from the cache when it can, and otherwise
+    queries for the host's records on a ServiceLoop.  Once all of a
+    host's addresses have expired, they continue to be returned for
+    up to staleTime seconds while a query to refresh them runs in the
+    background, so only the first lookup of a host (or one after a
+    long idle period) has to wait for the daemon.  At most maxEntries
+    hosts are kept; beyond that, the least recently used are
+    discarded.
+
+    Addresses reported to the application's own queries can be added
+    via query_callback(), which has the signature of a
+    DNSServiceQueryRecord() callback.
+
+    The hits, staleHits, and misses attributes count the lookups that
+    were answered with fresh addresses, answered with stale ones, and
+    had to wait for a query.
+
+    """
+
+    def __init__(self,
+                 loop,
+                 rrtypes = (kDNSServiceType_A, kDNSServiceType_AAAA),
+                 staleTime = 30,
+                 maxEntries = 1024,
+                 timeout = 5,
+                 grace = 0.25,
+                 ):
+
+        """
+
+        Create a cache whose queries run on loop.  A record of each
+        type in rrtypes is queried for each host.  timeout is the
+        default time, in seconds, allowed for a query to find an
+        address, and once one has been found, grace limits the time
+        the query continues to wait for others.
+
+        """
+
+        self.loop = loop
+        self.rrtypes = tuple(rrtypes)
+        self.staleTime = staleTime
+        self.timeout = timeout
+        self.grace = grace
+        self.hits = 0
+        self.staleHits = 0
+        self.misses = 0
+
+        # Maps host keys to dictionaries mapping each of the host's
+        # addresses to its expiry time
+        self._entries = _LRUCache(maxEntries)
+
+        # Maps host keys to the futures of queries in progress
+        self._queries = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _addresses(self, key, now):
+        # Returns the fresh and stale addresses of the host
+        fresh = []
+        stale = []
+        addresses = self._entries.get(key)
+        if addresses:
+            for address, expires in addresses.items():
+                if expires > now:
+                    fresh.append(address)
+                elif expires + self.staleTime > now:
+                    stale.append(address)
+        return fresh, stale
+
+    def get(self, hosttarget):
+        """
+
+        Return a list of the unexpired addresses of hosttarget in the
+        cache (which is empty if there are none).  Doesn't start a
+        query or affect the hit and miss counts.
+
+        """
+
+        return self._addresses(_name_key(hosttarget), time.time())[0]
+
+    def lookup(self,
+               hosttarget = _NO_DEFAULT,
+               interfaceIndex = kDNSServiceInterfaceIndexAny,
+               timeout = _NO_DEFAULT,
+               ):
+
+        """
+
+        Look up the addresses of hosttarget.  interfaceIndex is used
+        when a query is necessary.  Returns a Future whose result is a
+        list of printable addresses.  If a query is necessary and
+        finds no address within timeout seconds (by default, the
+        timeout given to the constructor), the future fails with a
+        BonjourError with error code kDNSServiceErr_Timeout.
+        Cancelling the future doesn't stop the query, whose results
+        are still cached.
+
+        """
+
+        _NO_DEFAULT.check(hosttarget)
+        if timeout is _NO_DEFAULT:
+            timeout = self.timeout
+
+        future = Future()
+        key = _name_key(hosttarget)
+        fresh, stale = self._addresses(key, time.time())
+
+        if fresh:
+            self.hits += 1
+            future.set_result(fresh)
+        elif stale:
+            self.staleHits += 1
+            future.set_result(stale)
+            self._query(key, hosttarget, interfaceIndex, self.timeout)
+        else:
+            self.misses += 1
+            query = self._query(key, hosttarget, interfaceIndex, timeout)
+            _chain_future(query, future)
+
+        return future
+
+    def _query(self, key, hosttarget, interfaceIndex, timeout):
+        query = self._queries.get(key)
+        if query is not None:
+            return query
+
+        query = Future()
+        refs = []
+        timers = []
+        answered = []
+
+        def finish():
+            if query.done():
+                return
+            addresses = self._addresses(key, time.time())[0]
+            if addresses:
+                query.set_result(addresses)
+            else:
+                query.set_exception(BonjourError(kDNSServiceErr_Timeout))
+
+        def callback(sdRef, flags, interfaceIndex, errorCode, fullname,
+                     rrtype, rrclass, rdata, ttl):
+            self.query_callback(sdRef, flags, interfaceIndex, errorCode,
+                                fullname, rrtype, rrclass, rdata, ttl)
+            if ((errorCode == kDNSServiceErr_NoError) and
+                (flags & kDNSServiceFlagsAdd) and
+                (not answered)):
+                # Give the other queries a little longer to answer
+                answered.append(True)
+                timers.append(self.loop.call_later(self.grace, finish))
+
+        def cleanup(query):
+            if self._queries.get(key) is query:
+                del self._queries[key]
+            for timer in timers:
+                timer.cancel()
+            for sdRef in refs:
+                if sdRef in self.loop:
+                    self.loop.remove(sdRef, close=True)
+                else:
+                    sdRef.close()
+
+        try:
+            for rrtype in self.rrtypes:
+                sdRef = DNSServiceQueryRecord(interfaceIndex=interfaceIndex,
+                                              fullname=hosttarget,
+                                              rrtype=rrtype,
+                                              callBack=callback,
+                                              sdRef=self.loop.connection)
+                refs.append(sdRef)
+                self.loop.add(sdRef)
+        except:
+            cleanup(query)
+            raise
+
+        if timeout is not None:
+            timers.append(self.loop.call_later(timeout, finish))
+
+        self._queries[key] = query
+        query.add_done_callback(cleanup)
+
+        return query
+
+    def query_callback(self, sdRef, flags, interfaceIndex, errorCode,
+                       fullname, rrtype, rrclass, rdata, ttl):
+        """
+
+        Update the cache in response to a DNSServiceQueryRecord()
+        reply.  Replies for records other than A and AAAA records are
+        ignored.
+
+        """
+
+        if ((errorCode != kDNSServiceErr_NoError) or
+            (rrclass != kDNSServiceClass_IN) or
+            (rrtype not in (kDNSServiceType_A, kDNSServiceType_AAAA))):
+            return
+
+        key = _name_key(fullname)
+        address = _rdata_to_address(rrtype, str(rdata))
+        addresses = self._entries.get(key)
+
+        if flags & kDNSServiceFlagsAdd:
+            if addresses is None:
+                addresses = self._entries[key] = {}
+            addresses[address] = time.time() + ttl
+        elif addresses is not None:
+            addresses.pop(address, None)
+
+    def invalidate(self, hosttarget):
+        """
+
+        Discard all cached addresses of hosttarget.
+
+        """
+
+        self._entries.pop(_name_key(hosttarget))
+
+    def clear(self):
+        """
+
+        Discard all cached addresses.
+
+        """
+
+        self._entries.clear()
+
+
+class RecordStore(object):
+
+    """
+
+    A set of individual records registered with
+    DNSServiceRegisterRecord() on a connection that the store creates
+    and owns, indexed by name and type so that they can be updated or
+    removed without the application keeping track of their
+    DNSRecordRefs.  Changes are made with upsert(), delete(), and
+    replace(), which call the daemon only when a record is added or
+    removed or its rdata or TTL actually changes, e.g.
+
+      store = RecordStore(loop=loop)
+      store.upsert('myhost.local.', kDNSServiceType_A,
+                   socket.inet_aton('10.0.0.1'), ttl=120)
+      ...
+      store.replace([('myhost.local.', kDNSServiceType_A,
+                      socket.inet_aton('10.0.0.2'), 120)])
+
+    Names are compared without regard to case or a trailing dot.
+    Each record is registered with the flags and interface index
+    given to the constructor, and registration results (e.g. name
+    conflicts for unique records) are reported to callBack, which has
+    the signature of a DNSServiceRegisterRecord() callback.  Closing
+    the store deregisters all of its records.
+
+    """
+
+    def __init__(self,
+                 flags = kDNSServiceFlagsShared,
+                 interfaceIndex = kDNSServiceInterfaceIndexAny,
+                 callBack = None,
+                 loop = None,
+                 ):
+
+        """
+
+        Create a store with a new connection to the daemon (available
+        as the sdRef attribute).  If loop is not None, the connection
+        is added to that ServiceLoop; otherwise, the application must
+        process its results in the usual way.
+
+        """
+
+        self.flags = flags
+        self.interfaceIndex = interfaceIndex
+        self._callBack = callBack
+        self._loop = loop
+
+        # Maps (name key, rrtype) to [fullname, rrclass, rdata, ttl,
+        # RecordRef]
+        self._records = {}
+
+        self.sdRef = DNSServiceCreateConnection()
+        if loop is not None:
+            loop.add(self.sdRef)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def __contains__(self, key):
+        'Return True if a record with key, a (fullname, rrtype) tuple, exists'
+        fullname, rrtype = key
+        return ((_name_key(fullname), rrtype) in self._records)
+
+    def __iter__(self):
+        'Return an iterator over the (fullname, rrtype) keys of the records'
+        return iter([(record[0], key[1])
+                     for key, record in self._records.items()])
+
+    def __len__(self):
+        'Return the number of records in the store'
+        return len(self._records)
+
+    def get(self, fullname, rrtype):
+        """
+
+        Return the tuple (rdata, ttl) for the specified record, or None
+        if there is no such record.
+
+        """
+
+        record = self._records.get((_name_key(fullname), rrtype))
+        if record is None:
+            return None
+        return record[2], record[3]
+
+    def _register_callback(self, sdRef, RecordRef, flags, errorCode):
+        if self._callBack is not None:
+            self._callBack(sdRef, RecordRef, flags, errorCode)
+
+    def upsert(self,
+               fullname = _NO_DEFAULT,
+               rrtype = _NO_DEFAULT,
+               rdata = _NO_DEFAULT,
+               ttl = 0,
+               rrclass = kDNSServiceClass_IN,
+               ):
+
+        """
+
+        Register the specified record, or update it if a record with
+        the same name and type is already registered.  rdata may be a
+        string or a TXTRecord instance, and the other arguments have
+        the same meaning as for DNSServiceRegisterRecord().  Returns
+        True if the daemon was called, or False if the record was
+        already registered with the same rdata and TTL.
+
+        """
+
+        _NO_DEFAULT.check(fullname)
+        _NO_DEFAULT.check(rrtype)
+        _NO_DEFAULT.check(rdata)
+
+        if isinstance(rdata, TXTRecord):
+            rdata = str(rdata)
+
+        key = (_name_key(fullname), rrtype)
+        record = self._records.get(key)
+
+        if record is None:
+            RecordRef = DNSServiceRegisterRecord(self.sdRef,
+                                                 self.flags,
+                                                 self.interfaceIndex,
+                                                 fullname,
+                                                 rrtype,
+                                                 rrclass,
+                                                 rdata,
+                                                 ttl,
+                                                 self._register_callback)
+            self._records[key] = [fullname, rrclass, rdata, ttl, RecordRef]
+            return True
+
+        if (record[2] == rdata) and (record[3] == ttl):
+            return False
+
+        DNSServiceUpdateRecord(self.sdRef, record[4], 0, rdata, ttl)
+        record[2] = rdata
+        record[3] = ttl
+        return True
+
+    def delete(self, fullname, rrtype):
+        """
+
+        Deregister the specified record.  Returns True if it existed,
+        or False if there was no such record.
+
+        """
+
+        record = self._records.pop((_name_key(fullname), rrtype), None)
+        if record is None:
+            return False
+        DNSServiceRemoveRecord(self.sdRef, record[4])
+        return True
+
+    def replace(self, records):
+        """
+
+        Make the store contain exactly the given records, each of which
+        is a tuple (fullname, rrtype, rdata), (fullname, rrtype, rdata,
+        ttl), or (fullname, rrtype, rdata, ttl, rrclass), by adding,
+        updating, and removing records as necessary.  Returns the
+        number of daemon calls made.
+
+        """
+
+        calls = 0
+        wanted = set()
+
+        for record in records:
+            fullname, rrtype = record[:2]
+            wanted.add((_name_key(fullname), rrtype))
+            if self.upsert(*record):
+                calls += 1
+
+        for key in list(self._records):
+            if key not in wanted:
+                DNSServiceRemoveRecord(self.sdRef, self._records.pop(key)[4])
+                calls += 1
+
+        return calls
+
+    def close(self):
+        """
+
+        Deregister all records and close the connection.
+
+        """
+
+        self._records.clear()
+        if (self._loop is not None) and (self.sdRef in self._loop):
+            self._loop.remove(self.sdRef)
+        self.sdRef.close()
+
+
+class ServiceReconciler(object):
+
+    """
+
+    Keeps the set of services registered by an application in line
+    with a desired set that may change frequently.  Each call to
+    reconcile() compares the complete desired set with what is
+    currently registered and makes only the changes needed:
+    registering new services, updating the TXT records of services
+    whose TXT record alone has changed (with DNSServiceUpdateRecord(),
+    which avoids the conflict probing and announcements caused by
+    registering a service again), re-registering services whose port
+    has changed, and closing services that are no longer wanted, e.g.
+
+      reconciler = ServiceReconciler(loop=loop)
+      reconciler.reconcile([('web', '_http._tcp', 80, txt1),
+                            ('ssh', '_ssh._tcp', 22)])
+      ...
+      reconciler.reconcile([('web', '_http._tcp', 80, txt2),
+                            ('ssh', '_ssh._tcp', 22)])   # 1 update
+
+    """
+
+    def __init__(self, callBack=None, loop=None, shareConnection=False):
+        """
+
+        Create a reconciler with no services registered.  If callBack
+        is not None, it is called with the signature of a
+        DNSServiceRegister() callback for each registration reply.  If
+        loop is not None, the DNSServiceRefs of the registrations are
+        added to that ServiceLoop; otherwise, the application must
+        process their results in the usual way.  If shareConnection
+        is true, the registrations share a single connection to the
+        daemon, available as the sdRef attribute (which is otherwise
+        None).
+
+        """
+
+        self._callBack = callBack
+        self._loop = loop
+
+        # Maps (name, regtype) to [sdRef, port, txtRecord]
+        self._services = {}
+
+        self.sdRef = None
+        if shareConnection:
+            self.sdRef = DNSServiceCreateConnection()
+            if loop is not None:
+                loop.add(self.sdRef)
+
+    def __contains__(self, key):
+        'Return True if key, a (name, regtype) tuple, is registered'
+        return (key in self._services)
+
+    def __getitem__(self, key):
+        'Return the DNSServiceRef of key, a (name, regtype) tuple'
+        return self._services[key][0]
+
+    def __iter__(self):
+        'Return an iterator over the (name, regtype) keys of the services'
+        return iter(list(self._services))
+
+    def __len__(self):
+        'Return the number of registered services'
+        return len(self._services)
+
+    def _register_callback(self, sdRef, flags, errorCode, name, regtype,
+                           domain):
+        if self._callBack is not None:
+            self._callBack(sdRef, flags, errorCode, name, regtype, domain)
+
+    def _register(self, key, port, txtRecord):
+        sdRef = DNSServiceRegister(name=key[0],
+                                   regtype=key[1],
+                                   port=port,
+                                   txtRecord=txtRecord,
+                                   callBack=self._register_callback,
+                                   sdRef=self.sdRef)
+        self._services[key] = [sdRef, port, txtRecord]
+        if self._loop is not None:
+            self._loop.add(sdRef)
+
+    def _deregister(self, key):
+        sdRef = self._services.pop(key)[0]
+        if (self._loop is not None) and (sdRef in self._loop):
+            self._loop.remove(sdRef, close=True)
+        else:
+            sdRef.close()
+
+    def reconcile(self, services):
+        """
+
+        Make the registered services match services, an iterable of
+        tuples (name, regtype, port) or (name, regtype, port,
+        txtRecord), whose elements have the same meaning as the
+        corresponding arguments of DNSServiceRegister() (except that
+        name must not be None).  A service is identified by its name
+        and type.  Returns the number of daemon calls made.
+
+        """
+
+        calls = 0
+        wanted = []
+        keys = set()
+
+        for service in services:
+            name, regtype, port = service[:3]
+            txtRecord = ''
+            if len(service) > 3:
+                txtRecord = service[3]
+            if isinstance(txtRecord, TXTRecord):
+                txtRecord = str(txtRecord)
+            if not txtRecord:
+                txtRecord = '\0'
+
+            key = (name, regtype)
+            if key in keys:
+                raise ValueError('service %r listed more than once' % (key,))
+            keys.add(key)
+            wanted.append((key, port, txtRecord))
+
+        for key in list(self._services):
+            if key not in keys:
+                self._deregister(key)
+                calls += 1
+
+        for key, port, txtRecord in wanted:
+            current = self._services.get(key)
+
+            if (current is not None) and (current[1] != port):
+                self._deregister(key)
+                calls += 1
+                current = None
+
+            if current is None:
+                self._register(key, port, txtRecord)
+                calls += 1
+            elif current[2] != txtRecord:
+                DNSServiceUpdateRecord(current[0], None, 0, txtRecord)
+                current[2] = txtRecord
+                calls += 1
+
+        return calls
+
+    def close(self):
+        """
+
+        Deregister all services (and close the shared connection, if
+        there is one).
+
+        """
+
+        if self.sdRef is not None:
+            # Closing the connection closes everything sharing it
+            self._services.clear()
+            if (self._loop is not None) and (self.sdRef in self._loop):
+                self._loop.remove(self.sdRef)
+            self.sdRef.close()
+        else:
+            for key in list(self._services):
+                self._deregister(key)
+
+
+class TXTUpdateScheduler(object):
+
+    """
+
+    Limits the rate at which the TXT records of registered services
+    are updated, for services that publish frequently changing state
+    (e.g. load) in their TXT records.  Every update causes the daemon
+    to announce the new record on the network, so update() sends at
+    most one update per record every minInterval seconds.  Updates
+    submitted while a record is within that interval are coalesced:
+    when the interval ends, only the most recent one is sent (and not
+    even that if it matches what was sent last).  flush() sends all
+    pending updates immediately, so the latest state is always
+    published.
+
+    The scheduler uses a ServiceLoop's timed calls, so the loop must
+    be running for pending updates to be sent.  The submitted and
+    sent attributes count the updates passed to update() and those
+    actually sent to the daemon.
+
+    """
+
+    def __init__(self, loop, minInterval=1.0):
+        self.loop = loop
+        self.minInterval = minInterval
+        self.submitted = 0
+        self.sent = 0
+
+        # Maps (sdRef value, RecordRef value) to [sdRef, RecordRef,
+        # last sent (txtRecord, ttl), pending (txtRecord, ttl) or
+        # None, timer] for each record updated within the last
+        # minInterval seconds
+        self._records = {}
+
+    def __len__(self):
+        'Return the number of records with an update pending'
+        pending = 0
+        for record in self._records.values():
+            if record[3] is not None:
+                pending += 1
+        return pending
+
+    def update(self, sdRef, txtRecord, RecordRef=None, ttl=0):
+        """
+
+        Update the TXT record of the service registered with sdRef to
+        txtRecord (a TXTRecord instance or a string), as soon as the
+        rate limit allows.  If RecordRef is not None, it must be a
+        DNSRecordRef returned by DNSServiceAddRecord() for sdRef, which
+        is updated instead.  ttl has the same meaning as for
+        DNSServiceUpdateRecord().
+
+        """
+
+        self.submitted += 1
+
+        if isinstance(txtRecord, TXTRecord):
+            txtRecord = str(txtRecord)
+        if not txtRecord:
+            txtRecord = '\0'
+
+        key = (sdRef.value, None)
+        if RecordRef is not None:
+            key = (sdRef.value, RecordRef.value)
+
+        record = self._records.get(key)
+        if record is None:
+            self._send(key, sdRef, RecordRef, (txtRecord, ttl))
+        else:
+            record[3] = (txtRecord, ttl)
+
+    def _send(self, key, sdRef, RecordRef, value):
+        DNSServiceUpdateRecord(sdRef, RecordRef, 0, value[0], value[1])
+        self.sent += 1
+        timer = self.loop.call_later(self.minInterval, self._interval_ended,
+                                     key)
+        self._records[key] = [sdRef, RecordRef, value, None, timer]
+
+    def _interval_ended(self, key):
+        sdRef, RecordRef, last, pending, timer = self._records.pop(key)
+        if ((pending is not None) and (pending != last) and sdRef._valid()
+            and ((RecordRef is None) or RecordRef._valid())):
+            self._send(key, sdRef, RecordRef, pending)
+
+    def flush(self):
+        """
+
+        Send all pending updates now.
+
+        """
+
+        for key, record in list(self._records.items()):
+            sdRef, RecordRef, last, pending, timer = record
+            if pending is None:
+                continue
+            if pending == last:
+                record[3] = None
+                continue
+            timer.cancel()
+            del self._records[key]
+            if sdRef._valid() and ((RecordRef is None) or RecordRef._valid()):
+                self._send(key, sdRef, RecordRef, pending)
+
+    def close(self):
+        """
+
+        Discard all pending updates.
+
+        """
+
+        for record in self._records.values():
+            record[4].cancel()
+        self._records.clear()
+
+
+################################################################################
+#
+# TXTRecord class
+#
+################################################################################
+
+
+
+class TXTRecord(object):
+
+    """
+
+    A mapping representing a DNS TXT record.  The TXT record's
+    name=value entries are stored as key/value pairs in the mapping.
+    Although keys can be accessed in a case-insensitive fashion
+    (meaning txt['foo'] and txt['FoO'] refer to the same value), key
+    case is preserved in the wire representation of the record (so
+    txt['FoO'] = 'bar' will generate a FoO=bar entry in the TXT
+    record).  Key order is also preserved, so keys appear in the wire
+    format in the order in which they were created.
+
+    Note that in addition to being valid as a txtRecord parameter to
+    DNSServiceRegister(), a TXTRecord instance can be used in place of
+    a resource record data string (i.e. rdata parameter) with any
+    function that accepts one.
+
+    """
+
+    __slots__ = ('strict', '_items', '_first', '_last', '_wire')
+
+    def __init__(self, items={}, strict=True):
+        """
+
+        Create a new TXTRecord instance, initializing it with the
+        contents of items.  If strict is true, then strict conformance
+        to the DNS TXT record format will be enforced, and attempts to
+        add a name containing invalid characters or a name/value pair
+        whose wire representation is longer than 255 bytes will raise
+        a ValueError exception.
+
+        """
+
+        self.strict = strict
+
+        # Maps each lowercased name to a [stored_name, value, prev,
+        # next] link, where prev and next are the lowercased names of
+        # the neighbouring items.  The links form a doubly-linked list
+        # in creation order, from self._first to self._last, so items
+        # can be added and removed in constant time.  Linking by name
+        # rather than by reference avoids reference cycles, so records
+        # are freed as soon as they're no longer used.
+        self._items = {}
+        self._first = self._last = None
+
+        # [strict, wire data, void pointer to wire data or None],
+        # discarded whenever the record is modified
+        self._wire = None
+
+        for name, value in items.iteritems():
+            self[name] = value
+
+    def __contains__(self, name):
+        'Return True if name is a key in the record, False otherwise'
+        # Names are usually lowercase already, in which case they can
+        # be looked up without lowercasing them
+        items = self._items
+        return (name in items) or (name.lower() in items)
+
+    def __iter__(self):
+        'Return an iterator over name/value pairs'
+        items = self._items
+        name = self._first
+        while name is not None:
+            link = items[name]
+            yield (link[0], link[1])
+            name = link[3]
+
+    def __len__(self):
+        'Return the number of name/value pairs'
+        return len(self._items)
+
+    def __nonzero__(self):
+        'Return False if the record is empty, True otherwise'
+        return bool(self._items)
+
+    def __reduce__(self):
+        # Instances have no __dict__, and the wire data cache can't be
+        # pickled, so pickle (and copy) the record as its name/value
+        # pairs, which keeps items that wouldn't survive a round trip
+        # through the wire format in a non-strict record
+        return (self.__class__, (), (self.strict, list(self)))
+
+    def __setstate__(self, state):
+        strict, items = state
+        self.strict = False
+        for name, value in items:
+            self[name] = value
+        self.strict = strict
+
+    def __str__(self):
+        """
+
+        Return the wire representation of the TXT record as a string.
+        If self.strict is false, any name/value pair whose wire length
+        if greater than 255 bytes will be truncated to 255 bytes.  If
+        the record is empty, '\\0' is returned.  The result is cached
+        until the record is modified.
+
+        """
+
+        wire = self._wire
+        if (wire is None) or (wire[0] != self.strict):
+            wire = self._wire = [self.strict, self._serialize(), None]
+        return wire[1]
+
+    def _serialize(self):
+        if not self:
+            return '\0'
+
+        parts = []
+        for name, value in self:
+            if value is None:
+                item = name
+            else:
+                item = '%s=%s' % (name, value)
+            if (not self.strict) and (len(item) > 255):
+                item = item[:255]
+            parts.append(chr(len(item)))
+            parts.append(item)
+
+        return ''.join(parts)
+
+    def _length_and_void_p(self):
+        # Returns the length of the wire data and a pointer to it for
+        # passing to the DNS-SD library, so that publishing an
+        # unchanged record repeatedly costs nothing
+        data = str(self)
+        wire = self._wire
+        if wire[2] is None:
+            wire[2] = ctypes.cast(ctypes.c_char_p(data), ctypes.c_void_p)
+        return len(data), wire[2]
+
+    def __getitem__(self, name):
         """
 
         Return the value associated with name.  The value is either
@@ -1996,12 +5345,32 @@ class TXTRecord(object):
         key.
 
         """
-        return self._items[name.lower()][1]
+        link = self._items.get(name)
+        if link is None:
+            link = self._items[name.lower()]
+        return link[1]
 
     # Require one or more printable ASCII characters (0x20-0x7E),
     # excluding '=' (0x3D)
     _valid_name_re = re.compile(r'^[ -<>-~]+$')
 
+    def _convert_value(self, name, value):
+        # Returns value as it will be stored for name, checking the
+        # length of the item if self.strict is true
+        length = len(name)
+
+        if value is not None:
+            if isinstance(value, unicode):
+                value = value.encode('utf-8')
+            else:
+                value = str(value)
+            length += 1 + len(value)
+
+        if self.strict and (length > 255):
+            raise ValueError('name=value string must be 255 bytes or less')
+
+        return value
+
     def __setitem__(self, name, value):
         """
 
@@ -2014,24 +5383,28 @@ class TXTRecord(object):
 
         stored_name = name
         name = name.lower()
-        length = len(name)
-
-        if value is not None:
-            if isinstance(value, unicode):
-                value = value.encode('utf-8')
-            else:
-                value = str(value)
-            length += 1 + len(value)
-
-        if self.strict and (length > 255):
-            raise ValueError('name=value string must be 255 bytes or less')
+        value = self._convert_value(name, value)
 
-        if name not in self._items:
+        link = self._items.get(name)
+        if link is None:
             if self.strict and (self._valid_name_re.match(stored_name) is None):
                 raise ValueError("invalid name: '%s'" % stored_name)
-            self._names.append(name)
+            self._append(name, stored_name, value)
+        else:
+            link[0] = stored_name
+            link[1] = value
+
+        self._wire = None
 
-        self._items[name] = (stored_name, value)
+    def _append(self, name, stored_name, value):
+        # Adds a new item at the end of the list
+        last = self._last
+        self._items[name] = [stored_name, value, last, None]
+        if last is None:
+            self._first = name
+        else:
+            self._items[last][3] = name
+        self._last = name
 
     def __delitem__(self, name):
         """
@@ -2040,9 +5413,21 @@ class TXTRecord(object):
         Raises KeyError if name is not a key.
 
         """
-        name = name.lower()
-        del self._items[name]
-        self._names.remove(name)
+        items = self._items
+        if name not in items:
+            name = name.lower()
+        prev, next_name = items.pop(name)[2:]
+
+        if prev is None:
+            self._first = next_name
+        else:
+            items[prev][3] = next_name
+        if next_name is None:
+            self._last = prev
+        else:
+            items[next_name][2] = prev
+
+        self._wire = None
 
     @classmethod
     def parse(cls, data, strict=False):
@@ -2050,24 +5435,356 @@ class TXTRecord(object):
 
         Given a string data containing the wire representation of a
         DNS TXT record, parse it and return a TXTRecord instance.  The
-        strict parameter is passed to the TXTRecord constructor.
+        strict parameter is passed to the TXTRecord constructor.  data
+        may also be a buffer object, such as the txtRecord passed to a
+        DNSServiceResolve() callback when zeroCopy is set.  (When only
+        a few of the record's keys are needed, a LazyTXTRecord avoids
+        decoding the rest.)
 
         """
 
-        txt = cls(strict=strict)
+        if not isinstance(data, str):
+            data = str(data)
 
-        while data:
-            length = ord(data[0])
-            item = data[1:length+1].split('=', 1)
+        txt = cls(strict=strict)
+        items = txt._items
+        last = last_link = None
+
+        # Walk the items with an offset, rather than slicing off each
+        # item in turn, so parsing takes time linear in the size of
+        # the record
+        end = len(data)
+        offset = 0
+
+        while offset < end:
+            start = offset + 1
+            offset = min(start + ord(data[offset]), end)
+
+            separator = data.find('=', start, offset)
+            if separator < 0:
+                stored_name = data[start:offset]
+                value = None
+            else:
+                stored_name = data[start:separator]
+                value = data[separator+1:offset]
 
             # Add the item only if the name is non-empty and there are
             # no existing items with the same name
-            if item[0] and (item[0] not in txt):
-                if len(item) == 1:
-                    txt[item[0]] = None
-                else:
-                    txt[item[0]] = item[1]
+            if not stored_name:
+                continue
+            name = stored_name.lower()
+            if name in items:
+                continue
+            if strict and (cls._valid_name_re.match(stored_name) is None):
+                raise ValueError("invalid name: '%s'" % stored_name)
 
-            data = data[length+1:]
+            # Link the items as TXTRecord._append() does
+            link = items[name] = [stored_name, value, last, None]
+            if last is None:
+                txt._first = name
+            else:
+                last_link[3] = name
+            last = name
+            last_link = link
 
+        txt._last = last
         return txt
+
+
+class LazyTXTRecord(TXTRecord):
+
+    """
+
+    A TXTRecord that wraps the wire representation of a DNS TXT record
+    and decodes it only as needed.  Nothing is parsed when the
+    instance is created.  Instead, an index mapping names to the
+    offsets of their values is built as the record is accessed:  a
+    lookup scans the wire data only as far as the requested name, and
+    a value is extracted only when it's looked up.  This makes it a
+    cheap replacement for TXTRecord.parse() when only a few keys of a
+    record are of interest.
+
+    Until the record is modified, str() returns the original wire data
+    unchanged (or '\\0' if it was empty).  Adding or removing a
+    name/value pair first decodes the whole record, after which the
+    instance behaves exactly like a TXTRecord.
+
+    """
+
+    __slots__ = ('_data', '_names', '_offsets', '_position')
+
+    def __init__(self, data='', strict=False):
+        """
+
+        Create a new LazyTXTRecord instance wrapping data, which is a
+        string or buffer object containing the wire representation of
+        a DNS TXT record.  A buffer is copied, so the instance remains
+        valid after a zeroCopy callback returns.  If strict is true,
+        names are checked (and a ValueError raised for an invalid one)
+        as they're indexed, rather than when the instance is created.
+
+        """
+
+        if not isinstance(data, str):
+            data = str(data)
+
+        self.strict = strict
+        self._data = data
+        self._names = []
+        self._items = None
+        self._wire = None
+
+        # Maps each lowercased name indexed so far to (stored_name,
+        # separator, end), the value being data[separator+1:end], or
+        # None if separator is negative
+        self._offsets = {}
+
+        # Offset of the first item not yet indexed
+        self._position = 0
+
+    @classmethod
+    def parse(cls, data, strict=False):
+        """
+
+        Return a LazyTXTRecord instance wrapping data.  Equivalent to
+        LazyTXTRecord(data, strict).
+
+        """
+        return cls(data, strict)
+
+    def __reduce__(self):
+        # Until it's modified, the record is its wire data
+        if self._data is None:
+            return TXTRecord.__reduce__(self)
+        return (self.__class__, (self._data, self.strict))
+
+    def _index(self, wanted=None):
+        # Extends the index until the item named wanted has been
+        # added, or to the end of the data, following the same rules
+        # as TXTRecord.parse()
+        data = self._data
+        strict = self.strict
+        names = self._names
+        offsets = self._offsets
+
+        end = len(data)
+        offset = self._position
+
+        while offset < end:
+            start = offset + 1
+            offset = min(start + ord(data[offset]), end)
+
+            separator = data.find('=', start, offset)
+            if separator < 0:
+                stored_name = data[start:offset]
+            else:
+                stored_name = data[start:separator]
+
+            if not stored_name:
+                continue
+            name = stored_name.lower()
+            if name in offsets:
+                continue
+            if strict and (self._valid_name_re.match(stored_name) is None):
+                raise ValueError("invalid name: '%s'" % stored_name)
+
+            names.append(name)
+            offsets[name] = (stored_name, separator, offset)
+            if name == wanted:
+                break
+
+        self._position = offset
+
+    def _lookup(self, name):
+        # Returns the offsets for name, indexing as far as needed to
+        # find it
+        name = name.lower()
+        if (name not in self._offsets) and \
+               (self._position < len(self._data)):
+            self._index(name)
+        return self._offsets[name]
+
+    def _item(self, name):
+        stored_name, separator, end = self._offsets[name]
+        if separator < 0:
+            return (stored_name, None)
+        return (stored_name, self._data[separator+1:end])
+
+    def _decode(self):
+        # Converts the instance into a plain TXTRecord, so that it
+        # can be modified
+        if self._data is None:
+            return
+        self._index()
+        self._items = {}
+        self._first = self._last = None
+        for name in self._names:
+            stored_name, value = self._item(name)
+            self._append(name, stored_name, value)
+        self._data = None
+        self._names = None
+        self._offsets = None
+
+    def __contains__(self, name):
+        if self._data is None:
+            return TXTRecord.__contains__(self, name)
+        try:
+            self._lookup(name)
+        except KeyError:
+            return False
+        return True
+
+    def __iter__(self):
+        if self._data is None:
+            return TXTRecord.__iter__(self)
+        self._index()
+        return (self._item(name) for name in self._names)
+
+    def __len__(self):
+        if self._data is None:
+            return TXTRecord.__len__(self)
+        self._index()
+        return len(self._names)
+
+    def __nonzero__(self):
+        if self._data is None:
+            return TXTRecord.__nonzero__(self)
+        if not self._names:
+            self._index()
+        return bool(self._names)
+
+    def _serialize(self):
+        if self._data is None:
+            return TXTRecord._serialize(self)
+        return (self._data or '\0')
+
+    def __getitem__(self, name):
+        if self._data is None:
+            return TXTRecord.__getitem__(self, name)
+        stored_name, separator, end = self._lookup(name)
+        if separator < 0:
+            return None
+        return self._data[separator+1:end]
+
+    def __setitem__(self, name, value):
+        self._decode()
+        TXTRecord.__setitem__(self, name, value)
+
+    def __delitem__(self, name):
+        self._decode()
+        TXTRecord.__delitem__(self, name)
+
+
+class CompactTXTRecord(TXTRecord):
+
+    """
+
+    A TXTRecord with a compact representation, for applications that
+    hold very many records in memory (e.g. one for each discovered
+    service instance).  Rather than a list, a dict and a tuple for
+    each name/value pair, a CompactTXTRecord holds one tuple of
+    lowercased names and one of stored names and values.  Names that
+    are str instances are interned, so that the names repeated across
+    many records are stored only once.
+
+    Lookups scan the (typically short) tuple of names, and each
+    modification builds new tuples, so a CompactTXTRecord is best
+    suited to records that are read much more often than changed.
+
+    """
+
+    __slots__ = ('_names',)
+
+    def __init__(self, items={}, strict=True):
+        """
+
+        Create a new CompactTXTRecord instance, initializing it with
+        the contents of items, which may be a mapping or a TXTRecord
+        instance (in which case its order is preserved).  strict has
+        the same meaning as for TXTRecord.
+
+        """
+
+        self.strict = strict
+        self._wire = None
+
+        if isinstance(items, TXTRecord):
+            items = iter(items)
+        else:
+            items = items.iteritems()
+
+        # _names holds the lowercased names, and _items the stored
+        # name and value of each pair in turn, i.e. the stored name
+        # and value for _names[i] are _items[2*i] and _items[2*i+1]
+        names = []
+        flat_items = []
+        for name, value in items:
+            self._assign(names, flat_items, name, value)
+        self._names = tuple(names)
+        self._items = tuple(flat_items)
+
+    @classmethod
+    def parse(cls, data, strict=False):
+        """
+
+        Given a string or buffer data containing the wire
+        representation of a DNS TXT record, parse it and return a
+        CompactTXTRecord instance, as for TXTRecord.parse().
+
+        """
+        return cls(TXTRecord.parse(data, strict), strict)
+
+    def _assign(self, names, items, name, value):
+        # Adds or replaces a name/value pair in the lists of names
+        # and items
+        stored_name = name
+        name = name.lower()
+        value = self._convert_value(name, value)
+
+        if isinstance(stored_name, str):
+            stored_name = _intern(stored_name)
+            name = _intern(name)
+
+        if name in names:
+            index = 2 * names.index(name)
+            items[index:index+2] = [stored_name, value]
+            return
+
+        if self.strict and (self._valid_name_re.match(stored_name) is None):
+            raise ValueError("invalid name: '%s'" % stored_name)
+        names.append(name)
+        items.extend((stored_name, value))
+
+    def _find(self, name):
+        try:
+            return 2 * self._names.index(name.lower())
+        except ValueError:
+            raise KeyError(name)
+
+    def __contains__(self, name):
+        return (name.lower() in self._names)
+
+    def __len__(self):
+        return len(self._names)
+
+    def __iter__(self):
+        items = self._items
+        for index in range(0, len(items), 2):
+            yield (items[index], items[index+1])
+
+    def __getitem__(self, name):
+        return self._items[self._find(name) + 1]
+
+    def __setitem__(self, name, value):
+        names = list(self._names)
+        items = list(self._items)
+        self._assign(names, items, name, value)
+        self._names = tuple(names)
+        self._items = tuple(items)
+        self._wire = None
+
+    def __delitem__(self, name):
+        index = self._find(name)
+        self._names = self._names[:index//2] + self._names[index//2+1:]
+        self._items = self._items[:index] + self._items[index+2:]
+        self._wire = None
@@ -26,11 +26,16 @@
 
 
 
+import copy
+import os
+import pickle
 import select
+import sys
 import threading
 import time
 import unittest
 
+import pybonjour
 from pybonjour import *
 
 
@@ -42,6 +47,11 @@ class TestPyBonjour(unittest.TestCase):
     fullname = 'TestService._test._tcp.local.'
     timeout = 2
 
+    def test_load(self):
+        load()
+        load()
+        self.assertRaises(ValueError, load, '/no/such/libdns_sd.so')
+
     def test_construct_fullname(self):
         # Check error handling
         self.assertRaises(ValueError, DNSServiceConstructFullName, None,
@@ -163,6 +173,761 @@ class TestPyBonjour(unittest.TestCase):
         finally:
             register_sdRef.close()
 
+    def test_process_result_timeout(self):
+        sdRef = DNSServiceQueryRecord(fullname='no-such-host.local.',
+                                      rrtype=kDNSServiceType_A)
+
+        try:
+            self.assertEqual(DNSServiceProcessResult(sdRef, timeout=0.1),
+                             False)
+            self.assertEqual(DNSServiceProcessResults(sdRef, timeout=0.1), 0)
+        finally:
+            sdRef.close()
+
+    def test_process_results(self):
+        called = []
+        batches = []
+
+        def batch_cb(_sdRef, events):
+            self.assertEqual(_sdRef, sdRef)
+            batches.append(events)
+
+        register_done, register_sdRef = self.register_record()
+
+        try:
+            self.wait_on_event(register_sdRef, register_done)
+
+            sdRef = DNSServiceBrowse(regtype=self.regtype,
+                                     callBack=lambda *args: called.append(args))
+
+            try:
+                ready = select.select([sdRef], [], [], self.timeout)
+                self.assert_(sdRef in ready[0], 'operation timed out')
+                processed = DNSServiceProcessResults(sdRef,
+                                                     batchCallBack=batch_cb)
+            finally:
+                sdRef.close()
+        finally:
+            register_sdRef.close()
+
+        self.assertEqual(called, [])
+        self.assertEqual(len(batches), 1)
+        self.assertEqual(len(batches[0]), processed)
+        self.assert_(self.service_name in
+                     [event[4] for event in batches[0]])
+
+    def test_process_results_close_in_callback(self):
+        called = []
+
+        def cb(_sdRef, flags, interfaceIndex, errorCode, fullname,
+               hosttarget, port, txtRecord):
+            self.assert_(_sdRef is sdRef)
+            called.append(port)
+            _sdRef.close()
+
+        register_done, register_sdRef = self.register_record()
+
+        try:
+            self.wait_on_event(register_sdRef, register_done)
+
+            sdRef = DNSServiceResolve(0, kDNSServiceInterfaceIndexAny,
+                                      self.service_name, self.regtype,
+                                      'local.', cb)
+
+            try:
+                processed = DNSServiceProcessResults(sdRef,
+                                                     timeout=self.timeout)
+            finally:
+                sdRef.close()
+        finally:
+            register_sdRef.close()
+
+        self.assertEqual(processed, 1)
+        self.assertEqual(called, [self.port])
+
+    def open_descriptors(self, limit):
+        # Opens descriptors until the next one would be at least
+        # limit, returning them, or None if the process isn't allowed
+        # that many
+        fds = []
+        try:
+            while (not fds) or (fds[-1] < limit - 1):
+                fds.append(os.open(os.devnull, os.O_RDONLY))
+        except OSError:
+            self.close_descriptors(fds)
+            return None
+        return fds
+
+    def close_descriptors(self, fds):
+        for fd in fds:
+            os.close(fd)
+
+    def test_process_result_timeout_high_fd(self):
+        # Waiting for a reply without holding the global lock mustn't
+        # rely on select() either
+        fds = self.open_descriptors(1024)
+        if fds is None:
+            return
+
+        try:
+            register_done, register_sdRef = self.register_record()
+
+            try:
+                self.assert_(register_sdRef.fileno() >= 1024)
+                while not register_done.isSet():
+                    self.assert_(DNSServiceProcessResult(register_sdRef,
+                                                         self.timeout),
+                                 'operation timed out')
+                self.assert_(not DNSServiceProcessResult(register_sdRef,
+                                                         0.1))
+            finally:
+                register_sdRef.close()
+        finally:
+            self.close_descriptors(fds)
+
+    def test_process_results_high_fd(self):
+        # select() can't handle descriptors of FD_SETSIZE (usually
+        # 1024) or more
+        fds = self.open_descriptors(1024)
+        if fds is None:
+            return
+
+        called = []
+
+        def cb(_sdRef, flags, interfaceIndex, errorCode, fullname,
+               hosttarget, port, txtRecord):
+            called.append(port)
+
+        try:
+            register_done, register_sdRef = self.register_record()
+
+            try:
+                while not register_done.isSet():
+                    DNSServiceProcessResults(register_sdRef)
+                self.assert_(register_sdRef.fileno() >= 1024)
+
+                sdRef = DNSServiceResolve(0, kDNSServiceInterfaceIndexAny,
+                                          self.service_name, self.regtype,
+                                          'local.', cb)
+
+                try:
+                    while not called:
+                        DNSServiceProcessResults(sdRef)
+                finally:
+                    sdRef.close()
+            finally:
+                register_sdRef.close()
+        finally:
+            self.close_descriptors(fds)
+
+        self.assertEqual(called, [self.port])
+
+    def test_service_loop(self):
+        loop = ServiceLoop()
+
+        def browse_cb(sdRef, flags, interfaceIndex, errorCode, serviceName,
+                      regtype, replyDomain):
+            self.assertEqual(errorCode, kDNSServiceErr_NoError)
+            self.assertEqual(sdRef, browse_sdRef)
+            if serviceName == self.service_name:
+                loop.remove(sdRef, close=True)
+
+        register_done, register_sdRef = self.register_record()
+
+        try:
+            self.wait_on_event(register_sdRef, register_done)
+
+            browse_sdRef = DNSServiceBrowse(regtype=self.regtype,
+                                            callBack=browse_cb)
+            loop.add(browse_sdRef)
+            loop.add(browse_sdRef)
+            self.assert_(browse_sdRef in loop)
+            self.assertEqual(len(loop), 1)
+
+            while browse_sdRef in loop:
+                self.assert_(loop.process(self.timeout) > 0,
+                             'operation timed out')
+
+            self.assertEqual(len(loop), 0)
+            self.assert_(browse_sdRef.value is None)
+        finally:
+            loop.close()
+            register_sdRef.close()
+
+    def test_service_loop_operations(self):
+        loop = ServiceLoop()
+        register_done, register_sdRef = self.register_record()
+
+        try:
+            self.wait_on_event(register_sdRef, register_done)
+
+            future = loop.resolve(kDNSServiceInterfaceIndexAny,
+                                  self.service_name, self.regtype, 'local.',
+                                  timeout=self.timeout)
+            result = loop.run_until_complete(future)
+            self.assertEqual(result[1], self.fullname)
+            self.assertEqual(result[3], self.port)
+            self.assertEqual(TXTRecord.parse(result[4])['foo'], 'foobar')
+            self.assertEqual(len(loop), 0)
+
+            future = loop.query_record(fullname='no-such-host.local.',
+                                       rrtype=kDNSServiceType_A)
+            self.assertEqual(len(loop), 1)
+            self.assert_(future.cancel())
+            self.assert_(future.cancelled())
+            self.assertRaises(CancelledError, future.result)
+            self.assertEqual(len(loop), 0)
+
+            future = loop.query_record(fullname='no-such-host.local.',
+                                       rrtype=kDNSServiceType_A,
+                                       timeout=0.1)
+            self.assertRaises(BonjourError, loop.run_until_complete, future)
+            self.assertEqual(future.exception().errorCode,
+                             kDNSServiceErr_Timeout)
+            self.assertEqual(len(loop), 0)
+        finally:
+            loop.close()
+            register_sdRef.close()
+
+    def test_resolve_zero_copy(self):
+        done = threading.Event()
+
+        def cb(_sdRef, flags, interfaceIndex, errorCode, fullname,
+               hosttarget, port, txtRecord):
+            self.assertEqual(errorCode, kDNSServiceErr_NoError)
+            self.assert_(isinstance(txtRecord, buffer))
+            self.assertEqual(TXTRecord.parse(txtRecord)['foo'], 'foobar')
+            done.set()
+
+        register_done, register_sdRef = self.register_record()
+
+        try:
+            self.wait_on_event(register_sdRef, register_done)
+
+            sdRef = DNSServiceResolve(0, kDNSServiceInterfaceIndexAny,
+                                      self.service_name, self.regtype,
+                                      'local.', cb, zeroCopy=True)
+
+            try:
+                self.wait_on_event(sdRef, done)
+            finally:
+                sdRef.close()
+        finally:
+            register_sdRef.close()
+
+    def test_service_loop_timers(self):
+        loop = ServiceLoop()
+        called = []
+
+        try:
+            loop.call_later(0.05, called.append, 2)
+            loop.call_later(0.01, called.append, 1)
+            loop.call_later(0.02, called.append, 3).cancel()
+            loop.run()
+            self.assertEqual(called, [1, 2])
+
+            # Only cancelled timers are left, so there's nothing to do
+            loop.call_later(5, called.append, 4).cancel()
+            start = time.time()
+            loop.run()
+            self.assert_(time.time() - start < 1)
+
+            loop.call_later(5, called.append, 5).cancel()
+            self.assertRaises(RuntimeError, loop.run_until_complete,
+                              Future())
+
+            future = Future()
+            loop.call_later(0.01, future.set_result, 'done')
+            self.assertEqual(loop.run_until_complete(future), 'done')
+            self.assertEqual(called, [1, 2])
+        finally:
+            loop.close()
+
+    def test_service_loop_errors(self):
+        errors = []
+
+        def error_cb(sdRef, error):
+            errors.append((sdRef, error))
+
+        loop = ServiceLoop(errorCallBack=error_cb)
+        register_done, register_sdRef = self.register_record()
+        process_results = pybonjour.DNSServiceProcessResults
+
+        # Fail the resolve, but keep serving the registration
+        def fail_resolve(sdRef, maxBatch):
+            if sdRef is not register_sdRef:
+                raise BonjourError(kDNSServiceErr_Unknown)
+            return process_results(sdRef, maxBatch)
+
+        try:
+            pybonjour.DNSServiceProcessResults = fail_resolve
+            loop.add(register_sdRef)
+
+            future = loop.resolve(kDNSServiceInterfaceIndexAny,
+                                  self.service_name, self.regtype, 'local.',
+                                  timeout=self.timeout)
+            while not (future.done() and register_done.isSet()):
+                self.assert_(loop.process(self.timeout) > 0,
+                             'operation timed out')
+
+            self.assertEqual(future.exception().errorCode,
+                             kDNSServiceErr_Unknown)
+            self.assertEqual(len(errors), 1)
+            self.assert_(errors[0][1] is future.exception())
+            self.assert_(register_sdRef in loop)
+            self.assertEqual(len(loop), 1)
+        finally:
+            pybonjour.DNSServiceProcessResults = process_results
+            loop.close()
+            register_sdRef.close()
+
+    def test_future_threads(self):
+        futures = [Future() for i in range(2000)]
+        called = []
+        completed = []
+        errors = []
+        start = threading.Event()
+
+        def add_callbacks_and_complete(value):
+            start.wait()
+            try:
+                for future in futures:
+                    future.add_done_callback(called.append)
+                    if future._finish('finished', value, None):
+                        completed.append(future)
+            except Exception:
+                errors.append(sys.exc_info()[1])
+
+        threads = [threading.Thread(target=add_callbacks_and_complete,
+                                    args=(i,))
+                   for i in range(3)]
+        for thread in threads:
+            thread.start()
+
+        # Switch threads as often as possible, to give races a chance
+        # to show up
+        interval = sys.getcheckinterval()
+        sys.setcheckinterval(1)
+        try:
+            start.set()
+            for thread in threads:
+                thread.join()
+        finally:
+            sys.setcheckinterval(interval)
+
+        self.assertEqual(errors, [])
+        self.assertEqual(len(completed), len(futures))
+        self.assertEqual(len(called), 3 * len(futures))
+
+    def test_service_worker(self):
+        done = threading.Event()
+        threads = []
+
+        def cb(sdRef, flags, errorCode, name, regtype, domain):
+            self.assertEqual(errorCode, kDNSServiceErr_NoError)
+            threads.append(threading.currentThread())
+            done.set()
+
+        worker = ServiceWorker()
+
+        try:
+            sdRef = worker.submit(DNSServiceRegister,
+                                  name=self.service_name,
+                                  regtype=self.regtype,
+                                  port=self.port,
+                                  callBack=cb).result(self.timeout)
+            self.assert_(sdRef in worker.loop)
+
+            done.wait(self.timeout)
+            self.assert_(done.isSet(), 'operation timed out')
+            self.assertNotEqual(threads[0], threading.currentThread())
+
+            worker.close_ref(sdRef).result(self.timeout)
+            self.assert_(sdRef.value is None)
+
+            future = worker.submit(DNSServiceBrowse)
+            self.assertRaises(ValueError, future.result, self.timeout)
+            self.assertEqual(worker.executed, 3)
+        finally:
+            worker.stop()
+
+    def test_service_worker_exit(self):
+        worker = ServiceWorker()
+        pending = []
+
+        # SystemExit ends the thread without printing a traceback
+        def exit_thread():
+            pending.append(worker.submit(len, ()))
+            raise SystemExit
+
+        try:
+            worker.submit(worker.loop.call_later, 0,
+                          exit_thread).result(self.timeout)
+            worker._thread.join(self.timeout)
+            self.assert_(not worker._thread.isAlive())
+
+            self.assert_(isinstance(pending[0].exception(0), RuntimeError))
+            self.assertRaises(RuntimeError, worker.submit, len, ())
+        finally:
+            worker.stop()
+
+    def test_service_browser(self):
+        loop = ServiceLoop()
+        events = []
+
+        def cb(sdRef, flags, interfaceIndex, errorCode, serviceName,
+               regtype, replyDomain):
+            self.assertEqual(errorCode, kDNSServiceErr_NoError)
+            events.append((flags & kDNSServiceFlagsAdd, serviceName))
+
+        register_done, register_sdRef = self.register_record()
+
+        try:
+            self.wait_on_event(register_sdRef, register_done)
+
+            browser = ServiceBrowser(self.regtype, callBack=cb, loop=loop)
+            instance = (self.service_name, self.regtype, 'local.')
+
+            try:
+                while instance not in browser:
+                    self.assert_(loop.process(self.timeout) > 0,
+                                 'operation timed out')
+                self.assert_(len(browser[instance]) > 0)
+                self.assert_(instance in list(browser))
+                self.assertEqual(events.count((kDNSServiceFlagsAdd,
+                                               self.service_name)), 1)
+            finally:
+                browser.close()
+
+            self.assertEqual(len(loop), 0)
+        finally:
+            loop.close()
+            register_sdRef.close()
+
+    def test_discovery_pipeline(self):
+        loop = ServiceLoop()
+        found = []
+
+        def cb(interfaceIndex, serviceName, regtype, replyDomain, hosttarget,
+               port, txtRecord, addresses):
+            if serviceName == self.service_name:
+                self.assertEqual(port, self.port)
+                self.assert_(len(addresses) > 0)
+                found.append(addresses)
+
+        register_done, register_sdRef = self.register_record()
+
+        try:
+            self.wait_on_event(register_sdRef, register_done)
+
+            pipeline = DiscoveryPipeline(loop, self.regtype, cb,
+                                         resolveConcurrency=1,
+                                         lookupConcurrency=1)
+
+            try:
+                while not found:
+                    self.assert_(loop.process(self.timeout) > 0,
+                                 'operation timed out')
+                self.assertEqual(pipeline.failures, 0)
+            finally:
+                pipeline.close()
+
+            self.assertEqual(len(loop), 0)
+        finally:
+            loop.close()
+            register_sdRef.close()
+
+    def test_register_many(self):
+        entries = [(self.service_name + str(i), self.regtype, self.port + i)
+                   for i in range(3)]
+        sdRef, outcomes = register_many(entries, timeout=self.timeout)
+
+        try:
+            self.assertEqual(len(outcomes), len(entries))
+            for entry, outcome in zip(entries, outcomes):
+                self.assertEqual(outcome[1], kDNSServiceErr_NoError)
+                self.assertEqual(outcome[2], entry[0])
+                self.assertEqual(outcome[0].fileno(), sdRef.fileno())
+
+            outcomes[0][0].close()
+            self.assert_(outcomes[1][0]._valid())
+        finally:
+            sdRef.close()
+
+        for outcome in outcomes:
+            self.assert_(not outcome[0]._valid())
+
+    def test_share_connection(self):
+        loop = ServiceLoop(shareConnection=True)
+
+        register_done, register_sdRef = self.register_record()
+
+        try:
+            self.wait_on_event(register_sdRef, register_done)
+
+            browser = ServiceBrowser(self.regtype, loop=loop)
+            self.assertEqual(browser.sdRef.fileno(), loop.connection.fileno())
+
+            futures = [loop.resolve(kDNSServiceInterfaceIndexAny,
+                                    self.service_name, self.regtype,
+                                    'local.', self.timeout)
+                       for i in range(3)]
+            self.assertEqual(len(loop), 1)
+
+            for future in futures:
+                result = loop.run_until_complete(future)
+                self.assertEqual(result[3], self.port)
+
+            browser.close()
+            self.assertEqual(len(loop), 1)
+            self.assertEqual(loop.connection._subordinates, {})
+        finally:
+            loop.close()
+            register_sdRef.close()
+
+    def test_share_connection_remove_in_callback(self):
+        loop = ServiceLoop(shareConnection=True)
+        found = []
+
+        def resolve_cb(_sdRef, flags, interfaceIndex, errorCode, fullname,
+                       hosttarget, port, txtRecord):
+            self.assertEqual(errorCode, kDNSServiceErr_NoError)
+            self.assert_(_sdRef is sdRef)
+            self.assert_(_sdRef in loop)
+            found.append(port)
+            loop.remove(_sdRef, close=True)
+
+        register_done, register_sdRef = self.register_record()
+
+        try:
+            self.wait_on_event(register_sdRef, register_done)
+
+            sdRef = DNSServiceResolve(0, kDNSServiceInterfaceIndexAny,
+                                      self.service_name, self.regtype,
+                                      'local.', resolve_cb,
+                                      sdRef=loop.connection)
+            loop.add(sdRef)
+
+            while not found:
+                self.assert_(loop.process(self.timeout) > 0,
+                             'operation timed out')
+
+            self.assertEqual(found, [self.port])
+            self.assert_(sdRef.value is None)
+            self.assertEqual(loop.connection._subordinates, {})
+            self.assertEqual(len(loop), 1)
+        finally:
+            loop.close()
+            register_sdRef.close()
+
+    def test_share_connection_early_reply(self):
+        connection = DNSServiceCreateConnection()
+        replies = []
+        register = pybonjour._DNSServiceRegister
+
+        def cb(sdRef, flags, errorCode, name, regtype, domain):
+            self.assertEqual(errorCode, kDNSServiceErr_NoError)
+            replies.append(sdRef)
+
+        # Process the reply before the call returns, as another thread
+        # using the connection could
+        def register_and_process(*args):
+            ref = register(*args)
+            pybonjour._DNSServiceProcessResult(connection)
+            return ref
+
+        def register_and_fail(*args):
+            raise BonjourError(kDNSServiceErr_BadParam)
+
+        try:
+            callbacks = len(pybonjour._callback_table)
+
+            pybonjour._DNSServiceRegister = register_and_process
+            sdRef = DNSServiceRegister(name=self.service_name,
+                                       regtype=self.regtype,
+                                       port=self.port,
+                                       callBack=cb,
+                                       sdRef=connection)
+            self.assertEqual(len(replies), 1)
+            self.assert_(replies[0] is sdRef)
+
+            pybonjour._DNSServiceRegister = register_and_fail
+            self.assertRaises(BonjourError, DNSServiceRegister,
+                              name=self.service_name, regtype=self.regtype,
+                              port=self.port, callBack=cb, sdRef=connection)
+            self.assertEqual(len(connection._subordinates), 1)
+
+            sdRef.close()
+            self.assertEqual(len(pybonjour._callback_table), callbacks)
+        finally:
+            pybonjour._DNSServiceRegister = register
+            connection.close()
+
+    def test_service_reconciler(self):
+        loop = ServiceLoop()
+        reconciler = ServiceReconciler(loop=loop)
+
+        try:
+            services = [(self.service_name + str(i), self.regtype,
+                         self.port + i, TXTRecord({'n': str(i)}))
+                        for i in range(3)]
+            self.assertEqual(reconciler.reconcile(services), 3)
+            self.assertEqual(len(loop), 3)
+            self.assertEqual(reconciler.reconcile(services), 0)
+
+            services[0] = services[0][:3] + (TXTRecord({'n': 'changed'}),)
+            del services[2]
+            self.assertEqual(reconciler.reconcile(services), 2)
+            self.assertEqual(len(reconciler), 2)
+            self.assertEqual(len(loop), 2)
+
+            key = (self.service_name + '1', self.regtype)
+            sdRef = reconciler[key]
+            services[1] = services[1][:2] + (self.port + 10,)
+            self.assertEqual(reconciler.reconcile(services), 2)
+            self.assert_(not sdRef._valid())
+            self.assert_(key in reconciler)
+        finally:
+            reconciler.close()
+            loop.close()
+
+        self.assertEqual(len(reconciler), 0)
+
+    def test_txt_update_scheduler(self):
+        loop = ServiceLoop()
+        scheduler = TXTUpdateScheduler(loop, minInterval=0.5)
+
+        register_done, register_sdRef = self.register_record()
+
+        try:
+            self.wait_on_event(register_sdRef, register_done)
+
+            for i in range(100):
+                scheduler.update(register_sdRef, TXTRecord({'load': str(i)}))
+            self.assertEqual((scheduler.submitted, scheduler.sent), (100, 1))
+            self.assertEqual(len(scheduler), 1)
+
+            while len(scheduler):
+                loop.process(self.timeout)
+            self.assertEqual(scheduler.sent, 2)
+
+            scheduler.update(register_sdRef, TXTRecord({'load': 'final'}))
+            scheduler.flush()
+            self.assertEqual(scheduler.sent, 3)
+            self.assertEqual(len(scheduler), 0)
+        finally:
+            scheduler.close()
+            loop.close()
+            register_sdRef.close()
+
+    def test_resolve_many(self):
+        register_done, register_sdRef = self.register_record()
+
+        try:
+            self.wait_on_event(register_sdRef, register_done)
+
+            instance = (self.service_name, self.regtype, 'local.')
+            missing = (kDNSServiceInterfaceIndexAny, 'NoSuchService',
+                       self.regtype, 'local.')
+            results, errors, timeouts = resolve_many([instance, missing],
+                                                     concurrency=1,
+                                                     deadline=self.timeout)
+
+            self.assertEqual(list(results), [instance])
+            self.assertEqual(results[instance][3], self.port)
+            self.assertEqual(errors, {})
+            self.assertEqual(timeouts, [missing])
+
+            self.assertRaises(ValueError, resolve_many, [instance],
+                              concurrency=0)
+        finally:
+            register_sdRef.close()
+
+    def test_resolve_cache(self):
+        loop = ServiceLoop()
+        cache = ResolveCache(loop, maxEntries=1)
+
+        register_done, register_sdRef = self.register_record()
+
+        try:
+            self.wait_on_event(register_sdRef, register_done)
+
+            args = (kDNSServiceInterfaceIndexAny, self.service_name,
+                    self.regtype, 'local.')
+            result = loop.run_until_complete(cache.resolve(*args),
+                                             self.timeout)
+            self.assertEqual(result[3], self.port)
+            self.assertEqual((cache.hits, cache.misses), (0, 1))
+
+            future = cache.resolve(*args)
+            self.assert_(future.done())
+            self.assertEqual(future.result(), result)
+            self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+            cache.browse_callback(None, 0, 0, kDNSServiceErr_NoError,
+                                  *args[1:])
+            self.assertEqual(len(cache), 0)
+            self.assert_(cache.get(*args) is None)
+        finally:
+            loop.close()
+            register_sdRef.close()
+
+    def test_resolve_cache_negative(self):
+        loop = ServiceLoop()
+        cache = ResolveCache(loop, holdDown=60)
+
+        try:
+            args = (kDNSServiceInterfaceIndexAny, 'NoSuchService',
+                    self.regtype, 'local.')
+            future = cache.resolve(timeout=1, *args)
+            self.assertRaises(BonjourError, loop.run_until_complete, future,
+                              self.timeout)
+            self.assertEqual(future.exception().errorCode,
+                             kDNSServiceErr_Timeout)
+
+            future = cache.resolve(*args)
+            self.assert_(future.done())
+            self.assertEqual(future.exception().errorCode,
+                             kDNSServiceErr_Timeout)
+            self.assertEqual(cache.negativeHits, 1)
+
+            cache.browse_callback(None, kDNSServiceFlagsAdd, 0,
+                                  kDNSServiceErr_NoError, *args[1:])
+            future = cache.resolve(*args)
+            self.assert_(not future.done())
+            future.cancel()
+            self.assertEqual(cache.negativeHits, 1)
+        finally:
+            loop.close()
+
+    def test_address_cache(self):
+        loop = ServiceLoop()
+        cache = AddressCache(loop)
+
+        register_done, register_sdRef = self.register_record()
+
+        try:
+            self.wait_on_event(register_sdRef, register_done)
+
+            hosttarget = loop.run_until_complete(
+                loop.resolve(kDNSServiceInterfaceIndexAny, self.service_name,
+                             self.regtype, 'local.'),
+                self.timeout)[2]
+
+            addresses = loop.run_until_complete(cache.lookup(hosttarget),
+                                                self.timeout)
+            self.assert_(len(addresses) > 0)
+            self.assertEqual((cache.hits, cache.misses), (0, 1))
+
+            future = cache.lookup(hosttarget.upper())
+            self.assert_(future.done())
+            self.assertEqual(sorted(future.result()), sorted(addresses))
+            self.assertEqual((cache.hits, cache.misses), (1, 1))
+            self.assertEqual(len(loop), 0)
+        finally:
+            loop.close()
+            register_sdRef.close()
+
     def query_record(self, rrtype, rdata):
         # Give record time to be updated...
         time.sleep(5)
@@ -244,6 +1009,75 @@ class TestPyBonjour(unittest.TestCase):
 
         self.assert_(RecordRef.value is None)
 
+    def test_record_store(self):
+        errors = []
+
+        def cb(sdRef, RecordRef, flags, errorCode):
+            errors.append(errorCode)
+
+        store = RecordStore(kDNSServiceFlagsUnique, callBack=cb)
+
+        try:
+            self.assert_(store.upsert(self.fullname, kDNSServiceType_SINK,
+                                      'blah'))
+            self.assert_(not store.upsert(self.fullname.upper(),
+                                          kDNSServiceType_SINK, 'blah'))
+            self.assert_((self.fullname, kDNSServiceType_SINK) in store)
+
+            while not errors:
+                self.assert_(DNSServiceProcessResult(store.sdRef,
+                                                     self.timeout),
+                             'operation timed out')
+            self.assertEqual(errors, [kDNSServiceErr_NoError])
+
+            self.assert_(store.upsert(self.fullname, kDNSServiceType_SINK,
+                                      'blah2'))
+            self.query_record(kDNSServiceType_SINK, 'blah2')
+
+            self.assertEqual(store.replace([]), 1)
+            self.assertEqual(len(store), 0)
+            self.assert_(not store.delete(self.fullname, kDNSServiceType_SINK))
+        finally:
+            store.close()
+
+        self.assert_(not store.sdRef._valid())
+
+    def test_removerecord_releases_memory(self):
+        cycles = 1000000
+        checkpoint = cycles // 10
+
+        sdRef = DNSServiceCreateConnection()
+
+        try:
+            for i in xrange(cycles):
+                RecordRef = DNSServiceRegisterRecord(
+                    sdRef,
+                    kDNSServiceFlagsShared,
+                    kDNSServiceInterfaceIndexLocalOnly,
+                    fullname=self.fullname,
+                    rrtype=kDNSServiceType_SINK,
+                    rdata='blah',
+                    callBack=lambda *args: None)
+                DNSServiceRemoveRecord(sdRef, RecordRef)
+                self.assert_(RecordRef.value is None)
+
+                # Read every reply waiting, so the daemon doesn't drop
+                # us for falling behind
+                if i % 1000 == 0:
+                    while DNSServiceProcessResults(sdRef, timeout=0):
+                        pass
+
+                if i % checkpoint == 0:
+                    self.assertEqual(len(sdRef._record_refs), 0)
+                    self.assertEqual(len(sdRef._callbacks), 0)
+                    if i == 0:
+                        callbacks = len(pybonjour._callback_table)
+                    else:
+                        self.assertEqual(len(pybonjour._callback_table),
+                                         callbacks)
+        finally:
+            sdRef.close()
+
     def test_txtrecord(self):
         txt = TXTRecord()
         self.assertEqual(len(txt), 0)
@@ -296,6 +1130,142 @@ class TestPyBonjour(unittest.TestCase):
         txt['x'] = value
         self.assertEqual(len(str(txt)), 256)
 
+    def test_txtrecord_parse(self):
+        data = '\x05a=one\x00\x05A=two\x01b\x02=x\x03c==\x02d='
+        txt = TXTRecord.parse(data)
+        self.assertEqual(list(txt), [('a', 'one'), ('b', None), ('c', '='),
+                                     ('d', '')])
+
+        # Truncated final item
+        txt = TXTRecord.parse('\x03a=b\x09c=d')
+        self.assertEqual(list(txt), [('a', 'b'), ('c', 'd')])
+
+        txt = TXTRecord.parse(buffer('\x03a=b'))
+        self.assertEqual(txt['a'], 'b')
+
+        self.assertRaises(ValueError, TXTRecord.parse, '\x03\x01=b', True)
+
+        data = str(TXTRecord(dict([('key%d' % i, 'x' * i)
+                                   for i in range(200)])))
+        self.assertEqual(str(TXTRecord.parse(data)), data)
+
+    def test_txtrecord_order(self):
+        txt = TXTRecord()
+        for name in ('a', 'B', 'c', 'D'):
+            txt[name] = None
+        del txt['A']
+        del txt['c']
+        del txt['d']
+        txt['a'] = '1'
+        txt['B'] = '2'
+        txt['e'] = '3'
+        self.assertEqual(list(txt), [('B', '2'), ('a', '1'), ('e', '3')])
+        self.assertEqual(str(txt), '\x03B=2\x03a=1\x03e=3')
+
+        for name in ('b', 'e', 'A'):
+            del txt[name]
+        self.assertEqual(list(txt), [])
+        self.assert_(not txt)
+        txt['f'] = None
+        self.assertEqual(list(txt), [('f', None)])
+
+    def test_txtrecord_wire_cache(self):
+        txt = TXTRecord({'a': 'one'})
+        data = str(txt)
+        self.assert_(str(txt) is data)
+        length, void_p = pybonjour._string_to_length_and_void_p(txt)
+        self.assertEqual(length, len(data))
+        self.assert_(pybonjour._string_to_length_and_void_p(txt)[1] is void_p)
+
+        self.assertRaises(ValueError, txt.__setitem__, 'b', 'x' * 300)
+        txt.strict = False
+        txt['b'] = 'x' * 300
+        self.assertEqual(len(str(txt)), len(data) + 256)
+        self.assert_(pybonjour._string_to_length_and_void_p(txt)[1] is not
+                     void_p)
+        del txt['b']
+        self.assertEqual(str(txt), data)
+
+        txt = LazyTXTRecord(data)
+        self.assert_(str(txt) is data)
+        txt['c'] = None
+        self.assertEqual(str(txt), data + '\x01c')
+
+    def test_lazytxtrecord(self):
+        data = '\x05a=one\x00\x05A=two\x01b\x02=x\x03c==\x02d='
+        txt = LazyTXTRecord(data)
+        self.assert_(isinstance(txt, TXTRecord))
+        self.assertEqual(txt._position, 0)
+        self.assertEqual(txt['A'], 'one')
+        self.assertEqual(txt._position, 6)
+        self.assertEqual(txt['b'], None)
+        self.assertRaises(KeyError, txt.__getitem__, 'x')
+        self.assertEqual(list(txt), list(TXTRecord.parse(data)))
+        self.assertEqual(len(txt), 4)
+        self.assert_('C' in txt)
+        self.assertEqual(str(txt), data)
+
+        txt['e'] = 'new'
+        del txt['a']
+        self.assertEqual(txt._data, None)
+        self.assertEqual(list(txt), [('b', None), ('c', '='), ('d', ''),
+                                     ('e', 'new')])
+        self.assertEqual(str(txt), '\x01b\x03c==\x02d=\x05e=new')
+
+        txt = LazyTXTRecord(buffer('\0'))
+        self.assert_(not txt)
+        self.assertEqual(str(txt), '\0')
+
+        txt = LazyTXTRecord('\x03\x01=b', strict=True)
+        self.assertRaises(ValueError, len, txt)
+
+    def test_compacttxtrecord(self):
+        txt = CompactTXTRecord.parse('\x05a=one\x00\x05A=two\x01b\x03c==',
+                                     True)
+        self.assertEqual(list(txt), [('a', 'one'), ('b', None), ('c', '=')])
+        self.assertEqual(txt['A'], 'one')
+        self.assertRaises(KeyError, txt.__getitem__, 'x')
+
+        txt['C'] = 'x'
+        del txt['b']
+        txt['d'] = ''
+        self.assertEqual(list(txt), [('a', 'one'), ('C', 'x'), ('d', '')])
+        self.assertRaises(KeyError, txt.__delitem__, 'b')
+        self.assertRaises(ValueError, txt.__setitem__, 'e=', 'x')
+        self.assertEqual(str(txt), str(TXTRecord.parse(str(txt))))
+
+        other = CompactTXTRecord(TXTRecord.parse(str(txt)))
+        self.assert_(other._names[0] is txt._names[0])
+        self.assertRaises(AttributeError, setattr, txt, 'extra', 1)
+
+        # Items that don't survive a round trip through the wire format
+        # are preserved
+        unusual = TXTRecord(strict=False)
+        unusual['a=b'] = 'c'
+        unusual['v'] = 'x' * 300
+
+        for txt in (TXTRecord({'a': 'one'}), LazyTXTRecord('\x03a=b'), txt,
+                    unusual, CompactTXTRecord(unusual, strict=False)):
+            for copied in (pickle.loads(pickle.dumps(txt)),
+                           pickle.loads(pickle.dumps(txt, 2)),
+                           copy.deepcopy(txt)):
+                self.assert_(type(copied) is type(txt))
+                self.assertEqual(list(copied), list(txt))
+                self.assertEqual(copied.strict, txt.strict)
+
+    def test_serviceinstance(self):
+        instance = ServiceInstance(u'My Server', u'_ftp._tcp.', u'local.')
+        self.assertEqual(instance, (u'My Server', u'_ftp._tcp.', u'local.'))
+        self.assertEqual(hash(instance),
+                         hash((u'My Server', u'_ftp._tcp.', u'local.')))
+        self.assertEqual(instance.name, u'My Server')
+        self.assertEqual(instance.domain, u'local.')
+
+        other = ServiceInstance(u'Other', u'_ftp._tcp.'.lower(), u'local.')
+        self.assert_(other.regtype is instance.regtype)
+        self.assertEqual(pickle.loads(pickle.dumps(instance)), instance)
+
+
 
 if __name__ == '__main__':
     unittest.main()